@@ -0,0 +1,252 @@
+"""Benchmark storing, restoring and re-rendering cached files
+
+Run from the repository root, for example:
+
+    python benchmarks/bench_resubmit.py --sizes 1K,1M,100M --output base.json
+    python benchmarks/bench_resubmit.py --sizes 1K,1M,100M --compare base.json
+
+Each size and backend is timed over --repeat runs, reporting the median
+latency and throughput of each phase, then run once more under tracemalloc
+to measure the peak memory Python allocates for it.
+"""
+# pylint: disable=import-error,wrong-import-position
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import django
+from django.conf import settings
+
+settings.configure(
+    CACHES={
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "file_resubmit": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        },
+    },
+    INSTALLED_APPS=["file_resubmit"],
+    # the widgets link to the preview view when rendered
+    ROOT_URLCONF=__name__,
+)
+django.setup()
+
+from django import forms
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.test.utils import override_settings
+from django import urls
+
+from file_resubmit import cache, widgets
+
+BACKENDS = {
+    "locmem": "django.core.cache.backends.locmem.LocMemCache",
+    "filebased": "django.core.cache.backends.filebased.FileBasedCache",
+    "filesystem": "file_resubmit.storage.FileSystemStore",
+}
+PHASES = ("store", "restore", "render")
+UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+class BenchForm(forms.Form):
+    """form with one resubmit file field"""
+
+    name = forms.CharField(required=True)
+    upload_file = forms.FileField(widget=widgets.ResubmitFileWidget())
+
+
+urlpatterns = [urls.path("file-resubmit/", urls.include("file_resubmit.urls"))]
+
+
+def parse_size(size):
+    """turn a size such as 512K or 100M into a number of bytes"""
+    size = size.strip().upper()
+    if size[-1] in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1]])
+    return int(size)
+
+
+def make_upload(size):
+    """an upload of random content, spooled to disk if it is large"""
+    if size <= settings.FILE_UPLOAD_MAX_MEMORY_SIZE:
+        return SimpleUploadedFile("bench.bin", os.urandom(size), "application/foo")
+    upload = TemporaryUploadedFile("bench.bin", "application/foo", size, None)
+    remaining = size
+    while remaining:
+        chunk = os.urandom(min(remaining, 1024**2))
+        upload.file.write(chunk)
+        remaining -= len(chunk)
+    upload.file.seek(0)
+    return upload
+
+
+def store(upload, key):
+    """cache a file"""
+    cache.FileCache().set(key, upload)
+
+
+def restore(upload, key):  # pylint: disable=unused-argument
+    """restore a file and read all its content"""
+    restored = cache.FileCache().get(key, "upload_file")
+    for _ in restored.chunks():
+        pass
+    restored.close()
+
+
+def render(upload, key):  # pylint: disable=unused-argument
+    """resubmit a form which fails validation again, and render it"""
+    form = BenchForm(data={"upload_file_cache_key": key})
+    form.is_valid()
+    str(form["upload_file"])
+
+
+def measure(phase, upload, key, repeat):
+    """time a phase, then measure its peak memory"""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        phase(upload, key)
+        durations.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    phase(upload, key)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(durations), peak
+
+
+def run(sizes, backends, repeat, overrides):
+    """run every phase for every size and backend"""
+    results = []
+    for backend in backends:
+        location = tempfile.mkdtemp(prefix="file_resubmit_bench_")
+        caches = dict(settings.CACHES)
+        caches["file_resubmit"] = {"BACKEND": BACKENDS[backend], "LOCATION": location}
+        with override_settings(CACHES=caches, **overrides):
+            for size in sizes:
+                upload = make_upload(size)
+                key = widgets.random_key()[:10]
+                for name in PHASES:
+                    latency, peak = measure(globals()[name], upload, key, repeat)
+                    results.append(
+                        {
+                            "backend": backend,
+                            "size": size,
+                            "phase": name,
+                            "latency": latency,
+                            "throughput": size / latency if latency else 0,
+                            "peak_memory": peak,
+                        }
+                    )
+                    print_result(results[-1])
+                upload.close()
+                cache.get_cache("file_resubmit").clear()
+        shutil.rmtree(location, ignore_errors=True)
+    return results
+
+
+def print_result(result, baseline=None):
+    """print one result, with the change from a baseline if there is one"""
+    line = (
+        f"{result['backend']:>10} {format_size(result['size']):>7} "
+        f"{result['phase']:>7} {result['latency'] * 1000:>10.3f} ms "
+        f"{result['throughput'] / 1024**2:>9.1f} MB/s "
+        f"{format_size(result['peak_memory']):>7} peak"
+    )
+    if baseline:
+        change = result["latency"] / baseline["latency"] - 1
+        line += f" {change:>+8.1%} latency"
+    print(line)
+
+
+def format_size(size):
+    """a short human readable size"""
+    for unit in ("G", "M", "K"):
+        if size >= UNITS[unit]:
+            return f"{size / UNITS[unit]:.0f}{unit}"
+    return f"{size}B"
+
+
+def environment():
+    """describe what was benchmarked, so results can be compared"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "platform": platform.platform(),
+    }
+
+
+def compare(results, path):
+    """print the change in latency from an earlier run"""
+    with open(path, encoding="utf-8") as baseline_file:
+        baseline = json.load(baseline_file)
+    print(f"\nCompared with {path} (commit {baseline['environment']['commit']}):")
+    earlier = {
+        (result["backend"], result["size"], result["phase"]): result
+        for result in baseline["results"]
+    }
+    for result in results:
+        match = earlier.get((result["backend"], result["size"], result["phase"]))
+        if match:
+            print_result(result, match)
+
+
+def main():
+    """run the benchmarks from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--sizes", default="1K,64K,1M,16M,128M")
+    parser.add_argument("--backends", default="locmem,filebased")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--chunk-size", type=parse_size)
+    parser.add_argument("--compression", choices=sorted(cache.CODECS))
+    parser.add_argument("--deduplicate", action="store_true")
+    parser.add_argument("--lazy", action="store_true")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare with results from --output")
+    args = parser.parse_args()
+
+    overrides = {
+        "FILE_RESUBMIT_CHUNK_SIZE": args.chunk_size,
+        "FILE_RESUBMIT_COMPRESSION": args.compression,
+        "FILE_RESUBMIT_DEDUPLICATE": args.deduplicate,
+        "FILE_RESUBMIT_LAZY": args.lazy,
+    }
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    backends = args.backends.split(",")
+    results = run(sizes, backends, args.repeat, overrides)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(
+                {
+                    "environment": environment(),
+                    "settings": overrides,
+                    "results": results,
+                },
+                output_file,
+                indent=2,
+            )
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""Load test resubmitting forms with many concurrent workers
+
+Run from the repository root, for example:
+
+    python benchmarks/loadtest.py --concurrency 1,8,32 --backends locmem,filebased
+    python benchmarks/loadtest.py --mode process --backends filesystem
+
+Each worker repeats the whole cycle a user goes through: a form is posted
+with a file but fails validation, and is posted again with only the cache
+key of the file, which then succeeds. Requests go through the Django test
+client, so the widgets, views and cache run as they do in a server. Threads
+share one process, and so LocMemCache's lock; processes only share the file
+based caches, whose files they contend for.
+"""
+# pylint: disable=import-error,wrong-import-position
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import django
+from django.conf import settings
+
+settings.configure(
+    CACHES={
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "file_resubmit": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        },
+    },
+    INSTALLED_APPS=["file_resubmit"],
+    ROOT_URLCONF=__name__,
+    ALLOWED_HOSTS=["testserver"],
+    DEBUG=False,
+)
+django.setup()
+
+from django import forms
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import HttpResponse
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import path
+
+from file_resubmit import cache, widgets
+
+BACKENDS = {
+    "locmem": "django.core.cache.backends.locmem.LocMemCache",
+    "filebased": "django.core.cache.backends.filebased.FileBasedCache",
+    "filesystem": "file_resubmit.storage.FileSystemStore",
+}
+UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3}
+PHASES = ("upload", "resubmit")
+PERCENTILES = (50, 95, 99)
+CACHE_KEY_RE = re.compile(r'name="upload_file_cache_key" value="([^"]+)"')
+
+
+class LoadForm(forms.Form):
+    """form with one resubmit file field"""
+
+    name = forms.CharField(required=True)
+    upload_file = forms.FileField(widget=widgets.ResubmitFileWidget())
+
+
+def submit(request):
+    """validate the form, rendering it again if it isn't valid"""
+    form = LoadForm(request.POST, request.FILES)
+    if form.is_valid():
+        form.cleaned_data["upload_file"].read()
+        return HttpResponse("saved")
+    return HttpResponse(str(form["upload_file"]), status=400)
+
+
+urlpatterns = [path("submit", submit)]
+
+
+def cycle(client, content):
+    """upload a file with a form that fails validation, then resubmit it
+
+    Returns the latency of each phase, and whether the cycle succeeded"""
+    start = time.perf_counter()
+    upload = SimpleUploadedFile("load.bin", content, "application/foo")
+    response = client.post("/submit", {"upload_file": upload})
+    uploaded = time.perf_counter()
+    match = CACHE_KEY_RE.search(response.content.decode())
+    if response.status_code != 400 or not match:
+        return {"upload": uploaded - start}, False
+
+    response = client.post(
+        "/submit", {"name": "load", "upload_file_cache_key": match.group(1)}
+    )
+    latencies = {"upload": uploaded - start, "resubmit": time.perf_counter() - uploaded}
+    return latencies, response.status_code == 200
+
+
+def worker(cycles, size):
+    """run cycles one after another, as one user would"""
+    content = os.urandom(size)
+    client = Client()
+    return [cycle(client, content) for _ in range(cycles)]
+
+
+def process_worker(cycles, size, test_settings):
+    """run a worker in a process of its own, which needs the settings"""
+    with override_settings(**test_settings):
+        return worker(cycles, size)
+
+
+def percentile(values, percent):
+    """the nearest-rank percentile of some values"""
+    ordered = sorted(values)
+    rank = max(-(-len(ordered) * percent // 100), 1)
+    return ordered[rank - 1]
+
+
+def run_level(mode, concurrency, cycles, size, test_settings):
+    """run a number of workers at once, and summarise their latencies"""
+    start = time.perf_counter()
+    if mode == "thread":
+        # the settings are global, so they are changed once for all threads
+        with override_settings(**test_settings), ThreadPoolExecutor(
+            max_workers=concurrency
+        ) as executor:
+            futures = [
+                executor.submit(worker, cycles, size) for _ in range(concurrency)
+            ]
+            results = [result for future in futures for result in future.result()]
+    else:
+        with ProcessPoolExecutor(max_workers=concurrency) as executor:
+            futures = [
+                executor.submit(process_worker, cycles, size, test_settings)
+                for _ in range(concurrency)
+            ]
+            results = [result for future in futures for result in future.result()]
+    elapsed = time.perf_counter() - start
+
+    summary = {
+        "mode": mode,
+        "concurrency": concurrency,
+        "size": size,
+        "cycles": len(results),
+        "failures": sum(1 for _, succeeded in results if not succeeded),
+        "throughput": len(results) / elapsed,
+        "phases": {},
+    }
+    for phase in PHASES:
+        latencies = [latency[phase] for latency, _ in results if phase in latency]
+        if latencies:
+            summary["phases"][phase] = {
+                f"p{percent}": percentile(latencies, percent) for percent in PERCENTILES
+            }
+    return summary
+
+
+def run(args, overrides):
+    """run every concurrency level with every backend"""
+    summaries = []
+    for backend in args.backends.split(","):
+        location = tempfile.mkdtemp(prefix="file_resubmit_load_")
+        caches = dict(settings.CACHES)
+        caches["file_resubmit"] = {
+            "BACKEND": BACKENDS[backend],
+            "LOCATION": location,
+            "OPTIONS": {"MAX_ENTRIES": args.max_entries},
+        }
+        test_settings = dict(overrides, CACHES=caches)
+        for concurrency in args.concurrency:
+            summary = run_level(
+                args.mode, concurrency, args.cycles, args.size, test_settings
+            )
+            summary["backend"] = backend
+            summaries.append(summary)
+            print_summary(summary)
+        shutil.rmtree(location, ignore_errors=True)
+    return summaries
+
+
+def parse_size(size):
+    """turn a size such as 512K or 100M into a number of bytes"""
+    size = size.strip().upper()
+    if size[-1] in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1]])
+    return int(size)
+
+
+def format_size(size):
+    """a short human readable size"""
+    for unit in ("G", "M", "K"):
+        if size >= UNITS[unit]:
+            return f"{size / UNITS[unit]:.0f}{unit}"
+    return f"{size}B"
+
+
+def print_summary(summary):
+    """print the results of one concurrency level"""
+    line = (
+        f"{summary['backend']:>10} {summary['mode']:>7} x{summary['concurrency']:<4} "
+        f"{format_size(summary['size']):>5} {summary['throughput']:>8.1f} cycles/s "
+        f"{summary['failures']:>4} failed"
+    )
+    for phase, latencies in summary["phases"].items():
+        line += f" | {phase} " + " ".join(
+            f"p{percent} {latencies[f'p{percent}'] * 1000:.1f}ms"
+            for percent in PERCENTILES
+        )
+    print(line)
+
+
+def main():
+    """run the load test from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--concurrency", default="1,4,16")
+    parser.add_argument("--mode", choices=["thread", "process"], default="thread")
+    parser.add_argument("--backends", default="locmem,filebased")
+    parser.add_argument("--cycles", type=int, default=50, help="for each worker")
+    parser.add_argument("--size", type=parse_size, default="64K")
+    parser.add_argument(
+        "--max-entries", type=int, default=300, help="before the cache is culled"
+    )
+    parser.add_argument("--chunk-size", type=parse_size)
+    parser.add_argument("--compression", choices=sorted(cache.CODECS))
+    parser.add_argument("--lazy", action="store_true")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+    args.concurrency = [int(level) for level in args.concurrency.split(",")]
+
+    overrides = {
+        "FILE_RESUBMIT_CHUNK_SIZE": args.chunk_size,
+        "FILE_RESUBMIT_COMPRESSION": args.compression,
+        "FILE_RESUBMIT_LAZY": args.lazy,
+    }
+    summaries = run(args, overrides)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(
+                {"settings": overrides, "results": summaries}, output_file, indent=2
+            )
+
+
+if __name__ == "__main__":
+    main()
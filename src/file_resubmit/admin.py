@@ -1,22 +1,32 @@
 """For admin views"""
 # pylint: disable=ungrouped-imports,import-error
 
+from django.conf import settings
 from django.db import models
 from django.utils.safestring import mark_safe
 
 try:
     from sorl.thumbnail.fields import ImageField
     from sorl.thumbnail.admin.current import AdminImageWidget as BaseWidget
+
+    # sorl-thumbnail's image fields validate images with their own form field
+    SORL_IMAGE_FIELDS = (ImageField,)
 except ImportError:
     from django.forms import ImageField
     from django.contrib.admin.widgets import AdminFileWidget as BaseWidget
 
-from .widgets import ResubmitBaseWidget, ResubmitFileWidget
+    SORL_IMAGE_FIELDS = ()
+
+from .fields import ResubmitImageField
+from .forms import ResubmitFormMixin, ResubmitFormSetMixin
+from .widgets import ResubmitBaseWidget, ResubmitFileWidget, delete_cached_files
 
 
 class AdminResubmitImageWidget(ResubmitBaseWidget, BaseWidget):
     """Image widget with render override"""
 
+    preview_image = True
+
     def render(
         self, name, value, attrs=None, **kwargs
     ):  # pylint: disable=unused-argument
@@ -26,16 +36,43 @@ class AdminResubmitImageWidget(ResubmitBaseWidget, BaseWidget):
         return mark_safe(output)
 
 
-class AdminResubmitMixin:  # pylint: disable=too-few-public-methods
-    """Admin mixin"""
+class AdminResubmitMixin:
+    """Admin mixin, whose form resolves all its files in a batch"""
+
+    def get_form(self, request, obj=None, **kwargs):
+        """add ResubmitFormMixin to the admin's form"""
+        form = super().get_form(request, obj, **kwargs)
+        if issubclass(form, ResubmitFormMixin):
+            return form
+        return type(form.__name__, (ResubmitFormMixin, form), {})
 
     def formfield_for_dbfield(self, db_field, **kwargs):
         """return the relevant formfield"""
 
-        if isinstance(db_field, (ImageField, models.ImageField)):
+        if isinstance(db_field, SORL_IMAGE_FIELDS):
             return db_field.formfield(widget=AdminResubmitImageWidget)
 
+        if isinstance(db_field, (ImageField, models.ImageField)):
+            return db_field.formfield(
+                form_class=ResubmitImageField, widget=AdminResubmitImageWidget
+            )
+
         if isinstance(db_field, models.FileField):
             return db_field.formfield(widget=ResubmitFileWidget)
 
         return super().formfield_for_dbfield(db_field, **kwargs)
+
+    def save_model(self, request, obj, form, change):
+        """save the object, then remove its files from the cache if set to"""
+        super().save_model(request, obj, form, change)
+        if getattr(settings, "FILE_RESUBMIT_DELETE_ON_SAVE", False):
+            delete_cached_files(form)
+
+
+class AdminResubmitInlineMixin(AdminResubmitMixin):
+    """Inline admin mixin, whose formset resolves all its files in a batch"""
+
+    def get_formset(self, request, obj=None, **kwargs):
+        """add ResubmitFormSetMixin to the inline's formset"""
+        formset = super().get_formset(request, obj, **kwargs)
+        return type(formset.__name__, (ResubmitFormSetMixin, formset), {})
@@ -1,10 +1,79 @@
 """Set up file cache"""
-# pylint: disable=import-error
+# pylint: disable=import-error, too-many-lines
 
-from io import BytesIO
+import hashlib
+import io
+import json
+import logging
+import os
+import struct
+import time
+import lzma
+import weakref
+import zlib
+from functools import partial
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.core.cache import caches
-from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import File
+from django.core.files.uploadedfile import (
+    InMemoryUploadedFile,
+    TemporaryUploadedFile,
+    UploadedFile,
+)
+
+from .metrics import report
+from .quotas import (
+    admit,
+    empty_usage,
+    keep_rejected_metadata,
+    quota_key,
+    quota_owner,
+    release,
+)
+from .sharding import ShardedCache
+from .writebehind import get_write_behind
+
+
+logger = logging.getLogger(__name__)
+
+CODECS = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+# content types whose files are already compressed
+COMPRESSED_CONTENT_TYPES = (
+    "application/epub+zip",
+    "application/gzip",
+    "application/x-7z-compressed",
+    "application/x-bzip2",
+    "application/x-rar-compressed",
+    "application/x-xz",
+    "application/zip",
+    "audio/*",
+    "image/gif",
+    "image/jpeg",
+    "image/png",
+    "image/webp",
+    "video/*",
+)
+
+
+# the most bytes yielded at once when streaming a file's content
+STREAM_BLOCK_SIZE = 64 * 1024
+
+METADATA_FIELDS = ("name", "size", "content_type", "charset", "checksum", "created")
+
+
+# records start with the magic bytes, the format version, and the lengths of
+# their fields, as JSON, and of the payload which follows them, if any
+RECORD_MAGIC = b"FRR"
+RECORD_VERSION = 1
+RECORD_HEADER = struct.Struct(">3sBII")
 
 
 def get_cache(cache_name):
@@ -12,48 +81,1130 @@ def get_cache(cache_name):
     return caches[cache_name]
 
 
-class FileCache:
+def is_record_key(key):
+    """could a key be the key of a file's record
+
+    The keys of content, chunks, blobs, quotas and namespaces all have a ":"
+    in them, so a key which has one never reads them as a record"""
+    return isinstance(key, str) and ":" not in key
+
+
+def content_key(key):
+    """get the cache key of the content of an unchunked entry"""
+    return f"{key}:content"
+
+
+def chunk_key(key, index):
+    """get the cache key of one chunk of a chunked entry"""
+    return f"{key}:{index}"
+
+
+def namespace_key(namespace):
+    """get the cache key of the list of keys stored under a namespace"""
+    return f"namespace:{namespace}"
+
+
+def chunk_count(size, chunk_size):
+    """how many chunks a file of a given size is stored in"""
+    return -(-size // chunk_size)
+
+
+def blob_key(digest, chunk_size=None, codec=None):
+    """get the cache key of the content shared by identical uploads"""
+    # blobs that are chunked or compressed are laid out differently in the cache
+    parts = ["blob", digest]
+    if chunk_size:
+        parts.append(str(chunk_size))
+    if codec:
+        parts.append(codec)
+    return ":".join(parts)
+
+
+def pack_record(state):
+    """encode the record of an entry as bytes, rather than having it pickled
+
+    Records written as dicts by earlier versions are still read, but those
+    versions can't read these, so they mustn't share the cache"""
+    fields = dict(state)
+    payload = fields.pop("content", b"")
+    encoded = json.dumps(fields, separators=(",", ":")).encode()
+    header = RECORD_HEADER.pack(
+        RECORD_MAGIC, RECORD_VERSION, len(encoded), len(payload)
+    )
+    return b"".join((header, encoded, payload))
+
+
+def unpack_record(value):
+    """decode a record written by pack_record(), without copying its payload"""
+    if isinstance(value, dict):
+        # records written as dicts, but not other dicts such as an owner's usage
+        return value if {"name", "size"} <= value.keys() else None
+    if not isinstance(value, (bytes, bytearray, memoryview)):
+        # such as a namespace's list of keys
+        return None
+    view = memoryview(value)
+    if len(view) < RECORD_HEADER.size:
+        return None
+    magic, version, fields_size, payload_size = RECORD_HEADER.unpack_from(view)
+    if magic != RECORD_MAGIC or version != RECORD_VERSION:
+        logger.warning("Ignoring a cached record of unknown format %r", magic)
+        return None
+    start = RECORD_HEADER.size
+    state = json.loads(bytes(view[start : start + fields_size]))
+    if payload_size:
+        start += fields_size
+        state["content"] = view[start : start + payload_size]
+    return state
+
+
+def unpack_records(values):
+    """decode the records fetched with get_many()"""
+    states = {}
+    for key, value in values.items():
+        state = unpack_record(value)
+        if state is not None:
+            states[key] = state
+    return states
+
+
+def content_digest(upload):
+    """hash the content of an upload without reading it all into memory"""
+    digest = hashlib.sha256()
+    for chunk in File.chunks(upload):
+        digest.update(chunk)
+    upload.file.seek(0)
+    return digest.hexdigest()
+
+
+def is_compressed_type(content_type):
+    """is a content type one whose files are already compressed"""
+    skip_types = getattr(
+        settings, "FILE_RESUBMIT_COMPRESSION_SKIP_TYPES", COMPRESSED_CONTENT_TYPES
+    )
+    content_type = (content_type or "").lower()
+    for skip_type in skip_types:
+        if skip_type.endswith("/*") and content_type.startswith(skip_type[:-1]):
+            return True
+        if content_type == skip_type:
+            return True
+    return False
+
+
+def compress(data, codec):
+    """compress data with a codec, or leave it as it is when there is no codec"""
+    return CODECS[codec][0](data) if codec else data
+
+
+def decompress(data, codec):
+    """reverse compress()"""
+    return CODECS[codec][1](data) if codec else data
+
+
+def read_upload(upload):
+    """read the whole content of an upload"""
+    upload.file.seek(0)
+    content = upload.file.read()
+    upload.file.seek(0)
+    return content
+
+
+def log_compression(upload, codec, stored_size):
+    """report how well an upload compressed"""
+    logger.debug(
+        "Compressed %s (%s) with %s: %d -> %d bytes, ratio %.2f",
+        upload.name,
+        upload.content_type,
+        codec,
+        upload.size,
+        stored_size,
+        compression_ratio(upload.size, stored_size),
+    )
+
+
+def compression_ratio(size, stored_size):
+    """the original size of a file over the size it takes in the cache"""
+    return size / stored_size if stored_size else 1.0
+
+
+class MemoryViewFile(io.BufferedIOBase):
+    """a read-only file over a bytes-like object, which is never copied whole"""
+
+    def __init__(self, buffer):
+        super().__init__()
+        self.view = memoryview(buffer).cast("B")
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        if self.closed:  # pylint: disable=using-constant-test
+            raise ValueError("I/O operation on closed file.")
+        end = len(self.view)
+        if size is not None and size >= 0:
+            end = min(self.position + size, end)
+        data = self.view[self.position : end].tobytes()
+        self.position = max(self.position, end)
+        return data
+
+    read1 = read
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        if offset < 0:
+            raise ValueError(f"negative seek position {offset}")
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def getbuffer(self):
+        """get a read-only view of the whole file"""
+        return self.view.toreadonly()
+
+
+def empty_upload(state, field_name):
+    """an empty upload for a cached file, spooled to disk if it is large"""
+    if state["size"] > settings.FILE_UPLOAD_MAX_MEMORY_SIZE:
+        return TemporaryUploadedFile(
+            name=state["name"],
+            content_type=state["content_type"],
+            size=state["size"],
+            charset=state["charset"],
+        )
+    return InMemoryUploadedFile(
+        file=io.BytesIO(),
+        field_name=field_name,
+        name=state["name"],
+        content_type=state["content_type"],
+        size=state["size"],
+        charset=state["charset"],
+    )
+
+
+def restore_upload(state, field_name, content):
+    """wrap cached content as an upload without copying small files"""
+    if state["size"] > settings.FILE_UPLOAD_MAX_MEMORY_SIZE:
+        upload = empty_upload(state, field_name)
+        view = memoryview(content)
+        for start in range(0, len(view), File.DEFAULT_CHUNK_SIZE):
+            upload.file.write(view[start : start + File.DEFAULT_CHUNK_SIZE])
+        upload.file.seek(0)
+        return upload
+    return InMemoryUploadedFile(
+        file=MemoryViewFile(content),
+        field_name=field_name,
+        name=state["name"],
+        content_type=state["content_type"],
+        size=state["size"],
+        charset=state["charset"],
+    )
+
+
+def restore_content(state, field_name, content):
+    """restore an upload from its whole, possibly compressed, content"""
+    return restore_upload(state, field_name, decompress(content, state.get("codec")))
+
+
+def restore_state(key, state, field_name, contents):
+    """restore an unchunked upload, given the content fetched for it"""
+    if "content" in state:
+        # entries written by earlier versions hold their content
+        return restore_content(state, field_name, state["content"])
+    content = contents.get(payload_key(key, state))
+    return None if content is None else restore_content(state, field_name, content)
+
+
+def payload_key(key, state):
+    """the key of the content of an unchunked entry"""
+    return state.get("blob") or content_key(key)
+
+
+def payload_keys(key, state):
+    """all the keys of the content of an entry, which may be chunked"""
+    if "content" in state:
+        return []
+    if "chunks" in state:
+        return [chunk_key(state.get("blob", key), i) for i in range(state["chunks"])]
+    return [payload_key(key, state)]
+
+
+def content_keys(states):
+    """the keys of the content of unchunked entries"""
+    return [
+        payload_key(key, state)
+        for key, state in states.items()
+        if "chunks" not in state and "content" not in state
+    ]
+
+
+def owned_keys(keys, states):
+    """all the cache keys used only by some entries"""
+    owned = list(keys)
+    for key, state in states.items():
+        if "blob" in state:
+            # content shared with identical uploads is left to expire
+            continue
+        if "chunks" in state:
+            owned += [chunk_key(key, index) for index in range(state["chunks"])]
+        elif "content" not in state:
+            owned.append(content_key(key))
+    return owned
+
+
+def store_events(admitted, rejected):
+    """describe stored files, and files which were over the limits, for metrics
+
+    Only the metadata of rejected files is stored, and none of the content
+    of files whose identical content was already cached"""
+    return [
+        (
+            key,
+            getattr(upload, "field_name", None),
+            upload.size,
+            outcome,
+            getattr(upload, "stored_size", 0),
+            getattr(upload, "compression_seconds", 0.0),
+        )
+        for uploads, outcome in ((admitted, "stored"), (rejected, "rejected"))
+        for key, upload in uploads.items()
+    ]
+
+
+def expected_keys(uploads):
+    """the keys set_many() will have stored, for files stored in the background
+
+    Only the limit on the size of each file is known in advance: files over
+    the limits on an owner's totals are found when they are stored"""
+    admitted, _, _ = admit(uploads)
+    if keep_rejected_metadata():
+        return list(uploads)
+    return list(admitted)
+
+
+def store_files(uploads, namespace):
+    """store files in a worker thread, which has a cache connection of its own"""
+    return FileCache().store_many(uploads, namespace)
+
+
+def key_created(key):
+    """when a key made by widgets.new_key() was made, as a Unix time
+
+    Keys made by earlier versions, and keys chosen by other code, don't say,
+    so this is None for them"""
+    key = key.rsplit("-", 1)[-1]
+    if len(key) != 18:
+        return None
+    try:
+        return int(key[:8], 16)
+    except ValueError:
+        return None
+
+
+def miss_outcome(key, expired_before):
+    """why a key wasn't found: it has expired, or else it was culled or unknown"""
+    created = key_created(key)
+    if None not in (created, expired_before) and created < expired_before:
+        return "expired"
+    return "miss"
+
+
+def get_events(field_names, states, uploads, expired_before=None):
+    """describe restored files, and files which couldn't be, for metrics
+
+    Entries made before expired_before have expired, if it is given"""
+    events = []
+    for key, field_name in field_names.items():
+        if key in uploads:
+            events.append((key, field_name, uploads[key].size, "hit"))
+        elif key in states and states[key].get("rejected"):
+            events.append((key, field_name, states[key]["size"], "rejected"))
+        elif key in states:
+            # the record was there but some of the content wasn't
+            events.append((key, field_name, states[key]["size"], "expired"))
+        else:
+            events.append((key, field_name, 0, miss_outcome(key, expired_before)))
+    return events
+
+
+def iter_range(content, start, end):
+    """yield blocks of the bytes of some content from start up to and including end"""
+    view = memoryview(content)[max(start, 0) : end + 1]
+    for offset in range(0, len(view), STREAM_BLOCK_SIZE):
+        yield bytes(view[offset : offset + STREAM_BLOCK_SIZE])
+
+
+def delete_events(keys, states):
+    """describe deleted files for metrics"""
+    return [
+        (key, None, states[key]["size"], "deleted")
+        if key in states
+        else (key, None, 0, "miss")
+        for key in keys
+    ]
+
+
+def describe(upload):
+    """the record of an upload, before its content is stored"""
+    return {
+        "name": upload.name,
+        "size": upload.size,
+        "content_type": upload.content_type,
+        "charset": upload.charset,
+        "created": time.time(),
+    }
+
+
+def rejected_entries(rejected):
+    """the records to cache for files which are over the limits, if any"""
+    if not keep_rejected_metadata():
+        return {}
+    return {
+        key: pack_record(dict(describe(upload), rejected=True))
+        for key, upload in rejected.items()
+    }
+
+
+def restorable(states):
+    """the entries whose content was cached"""
+    return {key: state for key, state in states.items() if not state.get("rejected")}
+
+
+def owner_quota_keys(states):
+    """the keys of the usage of the owners of some entries"""
+    owners = {state["owner"] for state in states.values() if state.get("owner")}
+    return [quota_key(owner) for owner in sorted(owners)]
+
+
+def image_info(state):
+    """the validation result recorded for a cached image, if it is still valid"""
+    image = state.get("image")
+    if image and image.get("checksum") == state.get("checksum"):
+        return image
+    return None
+
+
+def annotate(uploads, states):
+    """tell restored files which cache entry they came from"""
+    for key, upload in uploads.items():
+        upload.cache_key = key
+        upload.image_info = image_info(states[key])
+
+
+def metadata(state):
+    """the public description of a cached file"""
+    described = {field: state.get(field) for field in METADATA_FIELDS}
+    if state.get("rejected"):
+        # over the limits, so only this description was cached
+        described["rejected"] = True
+    return described
+
+
+async def acall(backend, method, *args):
+    """call a cache method through its async version"""
+    async_method = getattr(backend, f"a{method}", None)
+    if async_method is None:
+        # the async cache API was added in Django 4.0
+        async_method = sync_to_async(getattr(backend, method))
+    return await async_method(*args)
+
+
+class LazyUploadedFile(UploadedFile):
+    """a file restored from the cache which fetches its content on first use"""
+
+    def __init__(self, loader, state, field_name):
+        self.loader = loader
+        self.restored = None
+        super().__init__(
+            file=None,
+            name=state["name"],
+            content_type=state["content_type"],
+            size=state["size"],
+            charset=state["charset"],
+        )
+        self.field_name = field_name
+
+    @property
+    def file(self):
+        """fetch the content the first time it is needed"""
+        if self.restored is None:
+            self.restored = self.loader()
+            if self.restored is None:
+                raise FileNotFoundError(f"{self.name} is no longer in the cache")
+        return self.restored.file
+
+    @file.setter
+    def file(self, value):
+        # UploadedFile.__init__() sets the file, which is fetched later instead
+        pass
+
+    @property
+    def is_loaded(self):
+        """has the content been fetched yet"""
+        return self.restored is not None
+
+    def open(self, mode=None):
+        self.file.seek(0)
+        return self
+
+    def close(self):
+        # the request closes its files, which doesn't mean fetching them first
+        if self.restored is not None:
+            self.restored.close()
+
+
+def remove_file(path):
+    """remove a file unless it has already been removed or moved"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class LinkedUploadedFile(UploadedFile):
+    """a large file restored as a hard link to its content in the cache
+
+    Like a TemporaryUploadedFile it has a temporary_file_path(), so Django's
+    FileSystemStorage moves it into place rather than copying it"""
+
+    def __init__(self, path, state, field_name):
+        super().__init__(
+            file=open(path, "rb"),  # pylint: disable=consider-using-with
+            name=state["name"],
+            content_type=state["content_type"],
+            size=state["size"],
+            charset=state["charset"],
+        )
+        self.field_name = field_name
+        self.path = path
+        # the link is removed once the file is closed, unless it was moved
+        self.remove_link = weakref.finalize(self, remove_file, path)
+
+    def temporary_file_path(self):
+        """the path of the link"""
+        return self.path
+
+    def close(self):
+        try:
+            return self.file.close()
+        finally:
+            self.remove_link()
+
+
+class FileCache:  # pylint: disable=too-many-public-methods
     """The file cache for storing files temporarily"""
 
     def __init__(self):
         self.backend = self.get_backend()
+        self.chunk_size = getattr(settings, "FILE_RESUBMIT_CHUNK_SIZE", None)
+        self.deduplicate = getattr(settings, "FILE_RESUBMIT_DEDUPLICATE", False)
+        self.compression = getattr(settings, "FILE_RESUBMIT_COMPRESSION", None)
+        self.compression_min_size = getattr(
+            settings, "FILE_RESUBMIT_COMPRESSION_MIN_SIZE", 1024
+        )
+        self.lazy = getattr(settings, "FILE_RESUBMIT_LAZY", False)
+        self.timeout = getattr(settings, "FILE_RESUBMIT_TIMEOUT", DEFAULT_TIMEOUT)
+        self.write_behind = None
+        if getattr(settings, "FILE_RESUBMIT_WRITE_BEHIND", False):
+            self.write_behind = get_write_behind(
+                getattr(settings, "FILE_RESUBMIT_WRITE_BEHIND_WORKERS", 4),
+                getattr(settings, "FILE_RESUBMIT_WRITE_BEHIND_QUEUE_SIZE", 100),
+            )
+        if self.compression and self.compression not in CODECS:
+            raise ImproperlyConfigured(
+                f"FILE_RESUBMIT_COMPRESSION must be one of {', '.join(CODECS)}"
+            )
 
     # pylint: disable=no-self-use
     def get_backend(self):
-        """get the file_resubmit cache"""
+        """get the file_resubmit cache, or the caches set to spread files over"""
+        aliases = getattr(settings, "FILE_RESUBMIT_CACHES", None)
+        if aliases:
+            return ShardedCache(aliases)
         return get_cache("file_resubmit")
 
+    def get_codec(self, upload):
+        """choose how to compress an upload, if at all"""
+        if not self.compression or upload.size < self.compression_min_size:
+            return None
+        if is_compressed_type(upload.content_type):
+            return None
+        return self.compression
+
+    def lifetime(self):
+        """the seconds files are cached for, or None if they never expire"""
+        if self.timeout is DEFAULT_TIMEOUT:
+            return self.backend.default_timeout
+        return self.timeout
+
+    def expires(self):
+        """when files stored now expire, or None if they never do"""
+        lifetime = self.lifetime()
+        return None if lifetime is None else time.time() + lifetime
+
+    def expired_before(self):
+        """files stored before this time have expired, or None if they never do"""
+        lifetime = self.lifetime()
+        return None if lifetime is None else time.time() - lifetime
+
+    def new_state(self, key, upload, owner=None):
+        """describe an upload, and work out where and how to store its content"""
+        checksum = content_digest(upload)
+        state = describe(upload)
+        state["checksum"] = checksum
+        if owner:
+            state["owner"] = owner
+        codec = self.get_codec(upload)
+        if codec:
+            state["codec"] = codec
+
+        if self.deduplicate:
+            payload = blob_key(checksum, self.chunk_size, codec)
+            state["blob"] = payload
+        elif self.chunk_size:
+            payload = key
+        else:
+            payload = content_key(key)
+        return state, payload, codec
+
     def set(self, key, upload):
-        """add a file to the cache"""
-        upload.file.seek(0)
-        state = {
-            "name": upload.name,
-            "size": upload.size,
-            "content_type": upload.content_type,
-            "charset": upload.charset,
-            "content": upload.file.read(),
-        }
+        """add a file to the cache, returning whether it was cached"""
+        return bool(self.set_many({key: upload}))
+
+    async def aset(self, key, upload):
+        """add a file to the cache without blocking the event loop"""
+        return bool(await self.aset_many({key: upload}))
+
+    def set_many(self, uploads, namespace=None):
+        """add files to the cache, with one round-trip for all their entries
+
+        Chunks and deduplicated content still need a round-trip each. Returns
+        the keys of the files which were cached, as files over the limits on
+        cached files are not, or only have their metadata cached. The keys
+        are recorded under a namespace if one is given, so that they can be
+        deleted together with delete_namespace().
+
+        With FILE_RESUBMIT_WRITE_BEHIND, the files are stored in the
+        background unless too many are waiting already, and the keys of the
+        files which aren't over FILE_RESUBMIT_MAX_FILE_SIZE are returned."""
+        if self.write_behind and self.write_behind.submit(
+            store_files, uploads, namespace
+        ):
+            return expected_keys(uploads)
+        return self.store_many(uploads, namespace)
+
+    async def aset_many(self, uploads, namespace=None):
+        """async version of set_many()"""
+        if self.write_behind and await sync_to_async(self.write_behind.submit)(
+            store_files, uploads, namespace
+        ):
+            return expected_keys(uploads)
+        return await self.astore_many(uploads, namespace)
+
+    def store_many(self, uploads, namespace=None):  # pylint: disable=too-many-locals
+        """store files in the cache, for set_many()"""
+        started = time.perf_counter()
+        owner = quota_owner()
+        usage = None
+        if owner:
+            usage = self.backend.get(quota_key(owner)) or empty_usage()
+        admitted, rejected, usage = admit(uploads, usage, self.expires())
+
+        entries = {}
+        for key, upload in admitted.items():
+            # unless it is written, as content identical to it may be cached
+            upload.stored_size, upload.compression_seconds = 0, 0.0
+            state, payload, codec = self.new_state(key, upload, owner)
+            if self.chunk_size:
+                state["chunks"] = self.set_chunks(payload, upload, codec)
+                state["chunk_size"] = self.chunk_size
+            elif not (self.deduplicate and self.backend.touch(payload, self.timeout)):
+                entries[payload] = self.compress(upload, read_upload(upload), codec)
+            # the entry comes last so a partly stored file is never restored
+            entries[key] = pack_record(state)
+        entries.update(rejected_entries(rejected))
+        stored = [key for key in uploads if key in entries]
+        if usage is not None:
+            entries[quota_key(owner)] = usage
+        if namespace and stored:
+            recorded = self.backend.get(namespace_key(namespace)) or []
+            entries[namespace_key(namespace)] = sorted({*recorded, *stored})
+        if entries:
+            self.backend.set_many(entries, self.timeout)
+        report(FileCache, "set", store_events(admitted, rejected), started)
+        return stored
+
+    async def astore_many(
+        self, uploads, namespace=None
+    ):  # pylint: disable=too-many-locals
+        """async version of store_many()"""
+        started = time.perf_counter()
+        owner = quota_owner()
+        usage = None
+        if owner:
+            usage = await acall(self.backend, "get", quota_key(owner))
+            usage = usage or empty_usage()
+        admitted, rejected, usage = admit(uploads, usage, self.expires())
+
+        entries = {}
+        for key, upload in admitted.items():
+            # unless it is written, as content identical to it may be cached
+            upload.stored_size, upload.compression_seconds = 0, 0.0
+            state, payload, codec = self.new_state(key, upload, owner)
+            if self.chunk_size:
+                state["chunks"] = await self.aset_chunks(payload, upload, codec)
+                state["chunk_size"] = self.chunk_size
+            elif not (
+                self.deduplicate
+                and await acall(self.backend, "touch", payload, self.timeout)
+            ):
+                entries[payload] = self.compress(upload, read_upload(upload), codec)
+            entries[key] = pack_record(state)
+        entries.update(rejected_entries(rejected))
+        stored = [key for key in uploads if key in entries]
+        if usage is not None:
+            entries[quota_key(owner)] = usage
+        if namespace and stored:
+            recorded = await acall(self.backend, "get", namespace_key(namespace))
+            entries[namespace_key(namespace)] = sorted({*(recorded or []), *stored})
+        if entries:
+            await acall(self.backend, "set_many", entries, self.timeout)
+        report(FileCache, "set", store_events(admitted, rejected), started)
+        return stored
+
+    def set_chunks(self, key, upload, codec=None):
+        """stream a file into the cache with one key per chunk"""
+        if self.deduplicate:
+            count = chunk_count(upload.size, self.chunk_size)
+            if all(
+                self.backend.touch(chunk_key(key, i), self.timeout)
+                for i in range(count)
+            ):
+                # an identical upload is already cached
+                return count
+
+        count = 0
+        for count, chunk in enumerate(self.iter_upload(upload, codec), start=1):
+            self.backend.set(chunk_key(key, count - 1), chunk, self.timeout)
+        return count
+
+    async def aset_chunks(self, key, upload, codec=None):
+        """async version of set_chunks()"""
+        if self.deduplicate:
+            count = chunk_count(upload.size, self.chunk_size)
+            for index in range(count):
+                if not await acall(
+                    self.backend, "touch", chunk_key(key, index), self.timeout
+                ):
+                    break
+            else:
+                return count
+
+        count = 0
+        for count, chunk in enumerate(self.iter_upload(upload, codec), start=1):
+            await acall(
+                self.backend, "set", chunk_key(key, count - 1), chunk, self.timeout
+            )
+        return count
+
+    def iter_upload(self, upload, codec=None):
+        """yield the chunks of an upload as they are to be stored
+
+        The bytes stored and the seconds spent compressing them are noted on
+        the upload, for metrics"""
+        stored_size = 0
+        seconds = 0.0
+        # InMemoryUploadedFile.chunks() ignores chunk_size, File.chunks() doesn't
+        for chunk in File.chunks(upload, self.chunk_size):
+            started = time.perf_counter()
+            chunk = compress(chunk, codec)
+            seconds += time.perf_counter() - started
+            stored_size += len(chunk)
+            yield chunk
         upload.file.seek(0)
-        self.backend.set(key, state)
+        upload.stored_size = stored_size
+        upload.compression_seconds = seconds
+        if codec:
+            log_compression(upload, codec, stored_size)
+
+    def compress(self, upload, content, codec):
+        """compress the whole content of an upload, noting its stored size"""
+        started = time.perf_counter()
+        if codec:
+            content = compress(content, codec)
+            log_compression(upload, codec, len(content))
+        upload.stored_size = len(content)
+        upload.compression_seconds = time.perf_counter() - started if codec else 0.0
+        return content
 
     def get(self, key, field_name):
         """get a file from the cache"""
-        upload = None
-        state = self.backend.get(key)
-        if state:
-            f = BytesIO()
-            f.write(state["content"])
-            upload = InMemoryUploadedFile(
-                file=f,
-                field_name=field_name,
-                name=state["name"],
-                content_type=state["content_type"],
-                size=state["size"],
-                charset=state["charset"],
-            )
-            upload.file.seek(0)
+        return self.get_many({key: field_name}).get(key)
+
+    async def aget(self, key, field_name):
+        """get a file from the cache without blocking the event loop"""
+        return (await self.aget_many({key: field_name})).get(key)
+
+    def get_many(self, field_names):
+        """get files from the cache by key, with one round-trip for their entries
+
+        field_names maps each cache key to the name of the field it is for.
+        Only the files that could be restored are returned."""
+        started = time.perf_counter()
+        pending = self.get_pending(field_names)
+        keys = [key for key in field_names if key not in pending and is_record_key(key)]
+        states = unpack_records(self.backend.get_many(keys)) if keys else {}
+        if self.lazy:
+            uploads = self.get_lazy(restorable(states), field_names)
+        else:
+            uploads = self.restore_many(restorable(states), field_names)
+        annotate(uploads, states)
+        uploads.update(pending)
+        report(
+            FileCache,
+            "get",
+            get_events(field_names, states, uploads, self.expired_before()),
+            started,
+        )
+        return uploads
+
+    async def aget_many(self, field_names):
+        """async version of get_many()"""
+        started = time.perf_counter()
+        pending = self.get_pending(field_names)
+        keys = [key for key in field_names if key not in pending and is_record_key(key)]
+        states = {}
+        if keys:
+            states = unpack_records(await acall(self.backend, "get_many", keys))
+        if self.lazy:
+            uploads = await self.aget_lazy(restorable(states), field_names)
+        else:
+            uploads = await self.arestore_many(restorable(states), field_names)
+        annotate(uploads, states)
+        uploads.update(pending)
+        report(
+            FileCache,
+            "get",
+            get_events(field_names, states, uploads, self.expired_before()),
+            started,
+        )
+        return uploads
+
+    def get_pending(self, field_names):
+        """restore files which are still waiting to be stored in the background"""
+        if not self.write_behind:
+            return {}
+        uploads = self.write_behind.restore(field_names)
+        for key, upload in uploads.items():
+            upload.cache_key = key
+            upload.image_info = None
+        return uploads
+
+    def settle(self, keys=None):
+        """wait for files being stored in the background, before using the cache
+
+        This is for the few methods which change or describe entries"""
+        if self.write_behind:
+            self.write_behind.wait(keys)
+
+    def restore_many(self, states, field_names):
+        """fetch the content of entries and restore them"""
+        uploads = self.link_many(states, field_names)
+        states = {key: state for key, state in states.items() if key not in uploads}
+        keys = content_keys(states)
+        contents = self.backend.get_many(keys) if keys else {}
+
+        for key, state in states.items():
+            if "chunks" in state:
+                source = state.get("blob", key)
+                upload = self.get_chunked(source, state, field_names[key])
+            else:
+                upload = restore_state(key, state, field_names[key], contents)
+            if upload:
+                uploads[key] = upload
+        return uploads
+
+    async def arestore_many(self, states, field_names):
+        """async version of restore_many()"""
+        uploads = self.link_many(states, field_names)
+        states = {key: state for key, state in states.items() if key not in uploads}
+        keys = content_keys(states)
+        contents = await acall(self.backend, "get_many", keys) if keys else {}
+
+        for key, state in states.items():
+            if "chunks" in state:
+                source = state.get("blob", key)
+                upload = await self.aget_chunked(source, state, field_names[key])
+            else:
+                upload = restore_state(key, state, field_names[key], contents)
+            if upload:
+                uploads[key] = upload
+        return uploads
+
+    def get_metadata(self, key):
+        """describe a cached file without fetching its content
+
+        Returns its name, size, content_type, charset, checksum and created
+        time, or None if it isn't in the cache. Files which were over the
+        limits on cached files are also marked as rejected"""
+        if not is_record_key(key):
+            return None
+        self.settle([key])
+        state = unpack_record(self.backend.get(key))
+        return metadata(state) if state else None
+
+    async def aget_metadata(self, key):
+        """async version of get_metadata()"""
+        if not is_record_key(key):
+            return None
+        if self.write_behind:
+            await sync_to_async(self.settle)([key])
+        state = unpack_record(await acall(self.backend, "get", key))
+        return metadata(state) if state else None
+
+    def set_image_info(self, key, image):
+        """record the result of validating a cached file as an image
+
+        image is a dict with whether the image is valid ("valid") and, if it
+        is, its format, content_type, width and height. It is tied to the
+        file's checksum, so it isn't used if the entry now has other content"""
+        return bool(self.set_image_info_many({key: image}))
+
+    def set_image_info_many(self, images):
+        """record the results of validating several cached files as images
+
+        images maps cache keys to the dicts set_image_info() takes. Takes one
+        round-trip to read the records and one to write them, and returns
+        the keys whose results were recorded"""
+        keys = [
+            key
+            for key in images
+            if is_record_key(key)
+            # rather than hold up the request until the file is stored, the
+            # image is validated again if the form is resubmitted
+            and not (self.write_behind and self.write_behind.is_pending(key))
+        ]
+        states = unpack_records(self.backend.get_many(keys)) if keys else {}
+        entries = {}
+        for key, state in states.items():
+            if state.get("checksum"):
+                state["image"] = dict(images[key], checksum=state["checksum"])
+                entries[key] = pack_record(state)
+        if entries:
+            self.backend.set_many(entries, self.timeout)
+        return list(entries)
+
+    def get_lazy(self, states, field_names):
+        """restore files which only fetch their content when it is read
+
+        Their content is touched, without being fetched, so that a file whose
+        content has gone is a miss rather than a form which validates and
+        then can't be saved, and so that it lasts until the form is saved"""
+        uploads = {}
+        for key, state in states.items():
+            if "content" in state:
+                # the content came with the entry, so there's nothing to put off
+                upload = restore_state(key, state, field_names[key], {})
+                uploads[key] = upload
+            elif all(
+                self.backend.touch(payload, self.timeout)
+                for payload in payload_keys(key, state)
+            ):
+                loader = partial(self.restore, key, state, field_names[key])
+                uploads[key] = LazyUploadedFile(loader, state, field_names[key])
+        return uploads
+
+    async def aget_lazy(self, states, field_names):
+        """async version of get_lazy()"""
+        uploads = {}
+        for key, state in states.items():
+            if "content" in state:
+                upload = restore_state(key, state, field_names[key], {})
+                uploads[key] = upload
+                continue
+            for payload in payload_keys(key, state):
+                if not await acall(self.backend, "touch", payload, self.timeout):
+                    break
+            else:
+                loader = partial(self.restore, key, state, field_names[key])
+                uploads[key] = LazyUploadedFile(loader, state, field_names[key])
+        return uploads
+
+    def link_many(self, states, field_names):
+        """restore large files as links to their content, if the cache can
+
+        This needs a cache which keeps content as plain files, such as
+        FileSystemStore, and content which is neither chunked nor compressed.
+        Smaller files are kept in memory instead."""
+        if not hasattr(self.backend, "link"):
+            return {}
+        uploads = {}
+        for key, state in states.items():
+            if (
+                "chunks" in state
+                or "content" in state
+                or state.get("codec")
+                or state["size"] <= settings.FILE_UPLOAD_MAX_MEMORY_SIZE
+            ):
+                continue
+            path = self.backend.link(payload_key(key, state))
+            if path:
+                uploads[key] = LinkedUploadedFile(path, state, field_names[key])
+        return uploads
+
+    def restore(self, key, state, field_name):
+        """fetch the content of an entry and restore it"""
+        linked = self.link_many({key: state}, {key: field_name})
+        if linked:
+            return linked[key]
+        if "chunks" in state:
+            return self.get_chunked(state.get("blob", key), state, field_name)
+        contents = {}
+        if "content" not in state:
+            source = payload_key(key, state)
+            contents[source] = self.backend.get(source)
+        return restore_state(key, state, field_name, contents)
+
+    def get_chunked(self, key, state, field_name):
+        """stream the chunks of a file from the cache into a new upload"""
+        upload = empty_upload(state, field_name)
+        for chunk in self.iter_chunks(key, state):
+            if chunk is None:
+                # a chunk has expired or been culled: the file can't be restored
+                upload.close()
+                return None
+            upload.file.write(decompress(chunk, state.get("codec")))
+        upload.file.seek(0)
         return upload
 
+    async def aget_chunked(self, key, state, field_name):
+        """async version of get_chunked()"""
+        upload = empty_upload(state, field_name)
+        for index in range(state["chunks"]):
+            chunk = await acall(self.backend, "get", chunk_key(key, index))
+            if chunk is None:
+                upload.close()
+                return None
+            upload.file.write(decompress(chunk, state.get("codec")))
+        upload.file.seek(0)
+        return upload
+
+    def iter_chunks(self, key, state):
+        """yield the chunks of a chunked entry one at a time"""
+        for index in range(state["chunks"]):
+            yield self.backend.get(chunk_key(key, index))
+
+    def get_stream(self, key):
+        """describe a cached file, and stream its content
+
+        Returns its metadata and a function which yields the bytes of the
+        file from start up to and including end, or None if it isn't in the
+        cache. Only the chunks a range covers are fetched, one at a time, and
+        nothing is fetched until the bytes are read"""
+        started = time.perf_counter()
+        state = None
+        if is_record_key(key):
+            self.settle([key])
+            state = unpack_record(self.backend.get(key))
+        if not state:
+            outcome = (key, None, 0, miss_outcome(key, self.expired_before()))
+        elif state.get("rejected"):
+            outcome = (key, None, state["size"], "rejected")
+        else:
+            outcome = (key, None, state["size"], "hit")
+        report(FileCache, "stream", [outcome], started)
+        if outcome[3] != "hit":
+            return None
+        return metadata(state), partial(self.iter_content, key, state)
+
+    def iter_content(self, key, state, start=0, end=None):
+        """yield the bytes of an entry from start up to and including end"""
+        if end is None:
+            end = state["size"] - 1
+        if "content" in state:
+            yield from iter_range(state["content"], start, end)
+            return
+        if "chunks" not in state:
+            content = self.backend.get(payload_key(key, state))
+            if content is None:
+                logger.warning("The content of %s has expired while streaming", key)
+                return
+            yield from iter_range(decompress(content, state.get("codec")), start, end)
+            return
+
+        # chunks hold chunk_size bytes each before compression
+        chunk_size = state.get("chunk_size")
+        first = start // chunk_size if chunk_size else 0
+        offset = first * chunk_size if chunk_size else 0
+        for index in range(first, state["chunks"]):
+            if offset > end:
+                return
+            chunk = self.backend.get(chunk_key(state.get("blob", key), index))
+            if chunk is None:
+                logger.warning("A chunk of %s has expired while streaming", key)
+                return
+            chunk = decompress(chunk, state.get("codec"))
+            yield from iter_range(chunk, start - offset, end - offset)
+            offset += len(chunk)
+
+    def delete_namespace(self, namespace, keys=()):
+        """remove the files recorded under a namespace, and any other keys"""
+        # the namespace is only recorded once its files have been stored
+        self.settle()
+        recorded = self.backend.get(namespace_key(namespace)) or []
+        self.delete_many(sorted({*recorded, *keys}))
+        self.backend.delete(namespace_key(namespace))
+
+    async def adelete_namespace(self, namespace, keys=()):
+        """async version of delete_namespace()"""
+        if self.write_behind:
+            await sync_to_async(self.settle)()
+        recorded = await acall(self.backend, "get", namespace_key(namespace)) or []
+        await self.adelete_many(sorted({*recorded, *keys}))
+        await acall(self.backend, "delete", namespace_key(namespace))
+
     def delete(self, key):
         """remove a file from the cache using its key"""
-        self.backend.delete(key)
+        self.delete_many([key])
+
+    async def adelete(self, key):
+        """remove a file from the cache without blocking the event loop"""
+        await self.adelete_many([key])
+
+    def delete_many(self, keys):
+        """remove files from the cache using their keys"""
+        started = time.perf_counter()
+        self.settle(keys)
+        states = unpack_records(self.backend.get_many(keys))
+        self.backend.delete_many(owned_keys(keys, states))
+        quota_keys = owner_quota_keys(states)
+        if quota_keys:
+            usages = release(states, self.backend.get_many(quota_keys))
+            self.backend.set_many(usages, self.timeout)
+        report(FileCache, "delete", delete_events(keys, states), started)
+
+    async def adelete_many(self, keys):
+        """async version of delete_many()"""
+        started = time.perf_counter()
+        if self.write_behind:
+            await sync_to_async(self.settle)(keys)
+        states = unpack_records(await acall(self.backend, "get_many", keys))
+        await acall(self.backend, "delete_many", owned_keys(keys, states))
+        quota_keys = owner_quota_keys(states)
+        if quota_keys:
+            usages = await acall(self.backend, "get_many", quota_keys)
+            usages = release(states, usages)
+            await acall(self.backend, "set_many", usages, self.timeout)
+        report(FileCache, "delete", delete_events(keys, states), started)
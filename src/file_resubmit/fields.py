@@ -0,0 +1,98 @@
+"""Form fields"""
+# pylint: disable=import-error
+
+from django import forms
+from django.core.exceptions import ValidationError
+
+from .cache import FileCache
+from .widgets import ResubmitImageWidget
+
+
+class CachedImage:
+    """stands in for the Pillow image of a file whose validation was cached
+
+    ImageField.to_python() gives the files it validates the verified Pillow
+    image, which can only be used for its format and size"""
+
+    def __init__(self, image):
+        self.format = image["format"]
+        self.width = image["width"]
+        self.height = image["height"]
+        self.size = (self.width, self.height)
+
+
+class ResubmitImageField(forms.ImageField):
+    """image field which decodes a resubmitted image only the first time
+
+    The result of validating an image is recorded with its cache entry, and
+    used instead of opening the image with Pillow again when it is restored"""
+
+    widget = ResubmitImageWidget
+
+    # results waiting to be recorded by the form, which records them all at
+    # once, or None to record each as soon as it is known
+    pending_image_info = None
+
+    def to_python(self, data):
+        image = getattr(data, "image_info", None)
+        if image is None:
+            return self.validate_image(data)
+
+        if not image["valid"]:
+            raise ValidationError(
+                self.error_messages["invalid_image"], code="invalid_image"
+            )
+        upload = forms.FileField.to_python(self, data)
+        if upload is not None:
+            upload.image = CachedImage(image)
+            upload.content_type = image["content_type"]
+        return upload
+
+    def validate_image(self, data):
+        """validate an image with Pillow, and record the result if it's cached"""
+        cache_key = getattr(data, "cache_key", None)
+        try:
+            upload = super().to_python(data)
+        except ValidationError as error:
+            if cache_key and error.code == "invalid_image":
+                self.record_image_info(cache_key, {"valid": False})
+            raise
+        if upload is not None and cache_key:
+            self.record_image_info(
+                cache_key,
+                {
+                    "valid": True,
+                    "format": upload.image.format,
+                    "content_type": upload.content_type,
+                    "width": upload.image.width,
+                    "height": upload.image.height,
+                },
+            )
+        return upload
+
+    def record_image_info(self, cache_key, image):
+        """record the result of validating an image, or leave it to the form"""
+        if self.pending_image_info is None:
+            FileCache().set_image_info(cache_key, image)
+        else:
+            self.pending_image_info[cache_key] = image
+
+
+def defer_image_info(bound_forms):
+    """have the image fields of some forms leave their results to be recorded"""
+    for form in bound_forms:
+        for field in form.fields.values():
+            if isinstance(field, ResubmitImageField):
+                field.pending_image_info = {}
+
+
+def record_image_info(bound_forms):
+    """record the results the image fields of some forms left, in one batch"""
+    images = {}
+    for form in bound_forms:
+        for field in form.fields.values():
+            if isinstance(field, ResubmitImageField):
+                images.update(field.pending_image_info or {})
+                field.pending_image_info = None
+    if images:
+        FileCache().set_image_info_many(images)
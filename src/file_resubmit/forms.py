@@ -0,0 +1,78 @@
+"""Form helpers"""
+# pylint: disable=import-error
+
+from django.conf import settings
+from django.utils.functional import cached_property
+
+from .fields import defer_image_info, record_image_info
+from .widgets import (
+    delete_cached_files,
+    delete_formset_files,
+    formset_namespace,
+    resolve_files,
+    resolve_formset_files,
+)
+
+
+class ResubmitFormMixin:
+    """Form mixin which stores and restores all its files in a batch"""
+
+    def full_clean(self):
+        """resolve the files of all resubmit widgets before cleaning them
+
+        The results of validating images are recorded together afterwards"""
+        if not self.is_bound:
+            super().full_clean()
+            return
+        resolve_files(self)
+        defer_image_info([self])
+        try:
+            super().full_clean()
+        finally:
+            record_image_info([self])
+
+    def save(self, commit=True):
+        """save a model form, then remove its files from the cache if set to"""
+        instance = super().save(commit=commit)
+        if commit and getattr(settings, "FILE_RESUBMIT_DELETE_ON_SAVE", False):
+            delete_cached_files(self)
+        return instance
+
+
+class ResubmitFormSetMixin:
+    """Formset mixin which stores and restores the files of all its forms
+
+    The files are handled in one batch, under a namespace shared by every
+    submission of the formset, so they can be deleted together"""
+
+    @cached_property
+    def resubmit_namespace(self):
+        """the namespace of the formset's cached files"""
+        return formset_namespace(self)
+
+    def full_clean(self):
+        """resolve the files of all the forms before cleaning them"""
+        if not self.is_bound:
+            super().full_clean()
+            return
+        resolve_formset_files(self, self.resubmit_namespace)
+        defer_image_info(self.forms)
+        try:
+            super().full_clean()
+        finally:
+            record_image_info(self.forms)
+
+    def save(self, commit=True):
+        """save a model formset, then remove its files from the cache if set to"""
+        instances = super().save(commit=commit)
+        if commit and getattr(settings, "FILE_RESUBMIT_DELETE_ON_SAVE", False):
+            self.delete_cached_files()
+        return instances
+
+    def delete_cached_files(self):
+        """remove all the files cached for the formset
+
+        Files are removed when the formset is saved if
+        FILE_RESUBMIT_DELETE_ON_SAVE is set, but call this when it is
+        abandoned too, rather than leaving its files until they expire"""
+        delete_formset_files(self, self.resubmit_namespace)
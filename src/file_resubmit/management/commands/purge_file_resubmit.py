@@ -0,0 +1,62 @@
+"""Remove expired files from a file based file_resubmit cache"""
+# pylint: disable=import-error
+import os
+
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.management.base import BaseCommand, CommandError
+
+from file_resubmit.cache import get_cache
+from file_resubmit.storage import FileSystemStore
+
+
+class Command(BaseCommand):
+    """Purge expired cached files"""
+
+    help = "Remove expired files from a file based file_resubmit cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--cache",
+            default="file_resubmit",
+            help="the cache to purge (default: file_resubmit)",
+        )
+        parser.add_argument(
+            "--stale-after",
+            type=int,
+            help="the age in seconds of leftover links and temporary files of a "
+            "FileSystemStore to remove (default: a day)",
+        )
+
+    def handle(self, *args, **options):
+        backend = get_cache(options["cache"])
+        if isinstance(backend, FileSystemStore):
+            count, reclaimed = backend.purge_expired(options["stale_after"])
+        elif isinstance(backend, FileBasedCache):
+            count, reclaimed = purge_file_based_cache(backend)
+        else:
+            raise CommandError(
+                f"{backend.__class__.__name__} can't be purged: only "
+                "FileSystemStore and FileBasedCache caches are supported"
+            )
+        self.stdout.write(
+            f"Removed {count} expired entries, reclaiming {reclaimed} bytes"
+        )
+
+
+def purge_file_based_cache(backend):
+    """remove the expired entries of a FileBasedCache"""
+    # pylint: disable=protected-access
+    count = 0
+    reclaimed = 0
+    for path in backend._list_cache_files():
+        try:
+            size = os.path.getsize(path)
+            with open(path, "rb") as cache_file:
+                # this removes the file if it has expired
+                expired = backend._is_expired(cache_file)
+        except FileNotFoundError:
+            continue
+        if expired:
+            count += 1
+            reclaimed += size
+    return count, reclaimed
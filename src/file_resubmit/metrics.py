@@ -0,0 +1,108 @@
+"""Instrumentation of the file cache"""
+# pylint: disable=import-error
+import threading
+import time
+
+from django.conf import settings
+from django.dispatch import Signal
+from django.utils.module_loading import import_string
+
+# sent for each file stored, restored, streamed or deleted, with the arguments
+# operation ("set", "get", "stream" or "delete"), key, field_name, size,
+# outcome ("stored", "hit", "miss", "expired", "invalid", "rejected" or
+# "deleted"), duration, the seconds the call took, and for "set" only,
+# stored_size, the bytes written for the file's content after compression,
+# and compression_seconds, the seconds spent compressing it
+file_cache_operation = Signal()
+
+
+class Counters:
+    """Running totals of cache traffic, for a metrics exporter to read"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {}
+
+    def record_call(self, operation, duration):
+        """count a call to the file cache"""
+        with self.lock:
+            totals = self.get_totals(operation)
+            totals["calls"] += 1
+            totals["seconds"] += duration
+
+    def record(
+        self, operation, outcome, size, stored_size=None, compression_seconds=None
+    ):  # pylint: disable=too-many-arguments
+        """count one file handled by a call"""
+        with self.lock:
+            totals = self.get_totals(operation)
+            totals["files"] += 1
+            totals["bytes"] += size or 0
+            totals["stored_bytes"] += stored_size or 0
+            totals["compression_seconds"] += compression_seconds or 0.0
+            totals["outcomes"][outcome] = totals["outcomes"].get(outcome, 0) + 1
+
+    def get_totals(self, operation):
+        """the totals of an operation, which the lock must be held for"""
+        if operation not in self.totals:
+            self.totals[operation] = {
+                "calls": 0,
+                "seconds": 0.0,
+                "files": 0,
+                "bytes": 0,
+                "stored_bytes": 0,
+                "compression_seconds": 0.0,
+                "outcomes": {},
+            }
+        return self.totals[operation]
+
+    def snapshot(self):
+        """a copy of the totals for each operation"""
+        with self.lock:
+            return {
+                operation: dict(totals, outcomes=dict(totals["outcomes"]))
+                for operation, totals in self.totals.items()
+            }
+
+    def reset(self):
+        """start counting from zero again"""
+        with self.lock:
+            self.totals = {}
+
+
+counters = Counters()
+
+
+def get_callback():
+    """the callback set in FILE_RESUBMIT_METRICS_CALLBACK, if any"""
+    callback = getattr(settings, "FILE_RESUBMIT_METRICS_CALLBACK", None)
+    if isinstance(callback, str):
+        callback = import_string(callback)
+    return callback
+
+
+def report(sender, operation, events, started):
+    """report the files handled by one call to the file cache
+
+    events are (key, field_name, size, outcome) tuples, followed by the
+    stored_size and compression_seconds of stored files, and started is the
+    time.perf_counter() value from when the call began"""
+    duration = time.perf_counter() - started
+    counters.record_call(operation, duration)
+    callback = get_callback()
+    for key, field_name, size, outcome, *written in events:
+        stored_size, compression_seconds = written or (None, None)
+        counters.record(operation, outcome, size, stored_size, compression_seconds)
+        event = {
+            "operation": operation,
+            "key": key,
+            "field_name": field_name,
+            "size": size,
+            "outcome": outcome,
+            "duration": duration,
+            "stored_size": stored_size,
+            "compression_seconds": compression_seconds,
+        }
+        file_cache_operation.send(sender=sender, **event)
+        if callback:
+            callback(**event)
@@ -0,0 +1,22 @@
+"""Middleware"""
+# pylint: disable=import-error
+
+from .quotas import current_owner, get_owner
+
+
+class ResubmitOwnerMiddleware:
+    """Middleware which tells the file cache who is uploading files
+
+    This is needed for FILE_RESUBMIT_MAX_OWNER_BYTES and
+    FILE_RESUBMIT_MAX_OWNER_FILES. Place it after the session and
+    authentication middleware."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = current_owner.set(get_owner(request))
+        try:
+            return self.get_response(request)
+        finally:
+            current_owner.reset(token)
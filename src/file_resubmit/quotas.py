@@ -0,0 +1,117 @@
+"""Limits on what is cached, in total and for each visitor"""
+# pylint: disable=import-error
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+
+# who is uploading files in the current request, set by ResubmitOwnerMiddleware
+current_owner = ContextVar("file_resubmit_owner", default=None)
+
+
+def get_owner(request):
+    """identify who made a request: their user, session or address"""
+    user = getattr(request, "user", None)
+    if user is not None and user.is_authenticated:
+        return f"user:{user.pk}"
+    session = getattr(request, "session", None)
+    if session is not None and session.session_key:
+        return f"session:{session.session_key}"
+    return f"address:{request.META.get('REMOTE_ADDR')}"
+
+
+def quota_key(owner):
+    """get the cache key of the total size and number of an owner's files"""
+    return f"quota:{owner}"
+
+
+def quota_owner():
+    """the owner of the files being cached, if their totals are limited"""
+    if (
+        getattr(settings, "FILE_RESUBMIT_MAX_OWNER_BYTES", None) is None
+        and getattr(settings, "FILE_RESUBMIT_MAX_OWNER_FILES", None) is None
+    ):
+        return None
+    return current_owner.get()
+
+
+def keep_rejected_metadata():
+    """should files over the limits still have their metadata cached"""
+    over_limit = getattr(settings, "FILE_RESUBMIT_OVER_LIMIT", "skip")
+    return over_limit == "metadata"
+
+
+def admit(uploads, usage=None, expires=None):
+    """split uploads into the ones which may be cached and the ones which may not
+
+    usage holds the files already cached for the owner of the uploads, if
+    they are limited. Returns the admitted uploads, the rejected uploads,
+    and the owner's usage with the admitted uploads added, which expire at
+    expires."""
+    max_size = getattr(settings, "FILE_RESUBMIT_MAX_FILE_SIZE", None)
+    max_bytes = getattr(settings, "FILE_RESUBMIT_MAX_OWNER_BYTES", None)
+    max_files = getattr(settings, "FILE_RESUBMIT_MAX_OWNER_FILES", None)
+    if usage is not None:
+        usage = live_usage(usage)
+        total_bytes, total_files = usage_totals(usage)
+
+    admitted = {}
+    rejected = {}
+    for key, upload in uploads.items():
+        size = upload.size or 0
+        over_limit = max_size is not None and size > max_size
+        if usage is not None:
+            over_limit = (
+                over_limit
+                or (max_bytes is not None and total_bytes + size > max_bytes)
+                or (max_files is not None and total_files + 1 > max_files)
+            )
+        if over_limit:
+            rejected[key] = upload
+            continue
+        admitted[key] = upload
+        if usage is not None:
+            usage["entries"][key] = [size, expires]
+            total_bytes += size
+            total_files += 1
+    return admitted, rejected, usage
+
+
+def release(states, usages):
+    """take deleted files off their owners' usage
+
+    states maps the keys of the deleted files to their records"""
+    usages = {key: live_usage(usage) for key, usage in usages.items()}
+    for key, state in states.items():
+        usage = usages.get(quota_key(state.get("owner")))
+        if usage is not None:
+            usage["entries"].pop(key, None)
+    return usages
+
+
+def live_usage(usage, now=None):
+    """an owner's usage, without the files which have expired since
+
+    Usage maps each of the owner's cached keys to the size of its file and
+    the time it expires, if it does. Usage with only the totals, as earlier
+    versions kept it, is started again from nothing."""
+    now = time.time() if now is None else now
+    entries = usage.get("entries") or {}
+    return {
+        "entries": {
+            key: [size, expires]
+            for key, (size, expires) in entries.items()
+            if expires is None or expires > now
+        }
+    }
+
+
+def usage_totals(usage):
+    """the total bytes and number of the files in an owner's usage"""
+    entries = usage["entries"].values()
+    return sum(size for size, _ in entries), len(entries)
+
+
+def empty_usage():
+    """the usage of an owner with nothing cached"""
+    return {"entries": {}}
@@ -0,0 +1,112 @@
+"""Spreading cached files over several caches"""
+# pylint: disable=import-error
+
+import bisect
+import hashlib
+from collections import defaultdict
+from functools import lru_cache
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+# points on the ring for each cache, so keys are spread evenly between them
+VIRTUAL_NODES = 160
+
+
+def hash_key(key):
+    """the position of a key on the ring"""
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big")
+
+
+@lru_cache(maxsize=None)
+def build_ring(aliases, virtual_nodes=VIRTUAL_NODES):
+    """the sorted points of the ring, and the cache alias each belongs to"""
+    points = sorted(
+        (hash_key(f"{alias}#{index}"), alias)
+        for alias in aliases
+        for index in range(virtual_nodes)
+    )
+    return [point for point, _ in points], [alias for _, alias in points]
+
+
+class ShardedCache:
+    """Cache which spreads keys over several caches by consistent hashing
+
+    Each key is kept in the cache whose point on the ring follows the key's,
+    so adding or removing one of n caches only moves about 1/n of the keys.
+    It has the parts of the cache API FileCache uses. The async methods are
+    left to FileCache, which runs these in a thread."""
+
+    def __init__(self, aliases):
+        self.aliases = tuple(aliases)
+        self.points, self.owners = build_ring(self.aliases)
+
+    @property
+    def default_timeout(self):
+        """the timeout of the first cache, which the others should share"""
+        return caches[self.aliases[0]].default_timeout
+
+    def alias_for(self, key):
+        """the alias of the cache a key is kept in"""
+        index = bisect.bisect(self.points, hash_key(key)) % len(self.points)
+        return self.owners[index]
+
+    def shard(self, key):
+        """the cache a key is kept in"""
+        return caches[self.alias_for(key)]
+
+    def group(self, keys):
+        """split keys by the alias of the cache they are kept in"""
+        groups = defaultdict(list)
+        for key in keys:
+            groups[self.alias_for(key)].append(key)
+        return groups
+
+    def get(self, key, default=None, version=None):
+        """get a value from the cache it is kept in"""
+        return self.shard(key).get(key, default, version)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        """set a value in the cache it is kept in"""
+        self.shard(key).set(key, value, timeout, version)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        """set a value if it isn't already set"""
+        return self.shard(key).add(key, value, timeout, version)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        """update the expiry of a value"""
+        return self.shard(key).touch(key, timeout, version)
+
+    def delete(self, key, version=None):
+        """remove a value"""
+        return self.shard(key).delete(key, version)
+
+    def has_key(self, key, version=None):
+        """is a value in the cache"""
+        return self.shard(key).has_key(key, version)
+
+    def get_many(self, keys, version=None):
+        """get values with one round-trip to each cache they are kept in"""
+        found = {}
+        for alias, shard_keys in self.group(keys).items():
+            found.update(caches[alias].get_many(shard_keys, version))
+        return found
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        """set values with one round-trip to each cache they are kept in"""
+        failed = []
+        for alias, shard_keys in self.group(data).items():
+            shard_data = {key: data[key] for key in shard_keys}
+            failed.extend(caches[alias].set_many(shard_data, timeout, version) or [])
+        return failed
+
+    def delete_many(self, keys, version=None):
+        """remove values with one round-trip to each cache they are kept in"""
+        for alias, shard_keys in self.group(keys).items():
+            caches[alias].delete_many(shard_keys, version)
+
+    def clear(self):
+        """empty all the caches"""
+        for alias in self.aliases:
+            caches[alias].clear()
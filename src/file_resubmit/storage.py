@@ -0,0 +1,212 @@
+"""A cache backend made for storing files"""
+# pylint: disable=import-error
+
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import uuid
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+
+class FileSystemStore(BaseCache):
+    """Cache backend which keeps bytes values as plain files
+
+    Each value is a file in a subdirectory picked from the hash of its key,
+    with a small JSON sidecar file holding its expiry time. Bytes values are
+    written as they are and read back through mmap; other values are pickled.
+    """
+
+    meta_suffix = ".meta"
+    links_directory = "links"
+    # the prefix of the files values are written to before they are in place
+    temp_prefix = "tmp"
+    # links and half written files left this many seconds by processes which
+    # died before removing them are purged
+    stale_after = 24 * 60 * 60
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        self.location = os.path.abspath(location)
+        self.depth = int(params.get("OPTIONS", {}).get("SHARD_DEPTH", 2))
+        os.makedirs(self.location, 0o700, exist_ok=True)
+
+    def key_to_path(self, key, version=None):
+        """get the path of the file holding a key's value"""
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        shards = [digest[index * 2 : index * 2 + 2] for index in range(self.depth)]
+        return os.path.join(self.location, *shards, digest)
+
+    def read_meta(self, path):
+        """read the sidecar of a value, or None if it is missing or expired"""
+        try:
+            with open(path + self.meta_suffix, "rb") as meta_file:
+                meta = json.load(meta_file)
+        except (FileNotFoundError, ValueError):
+            return None
+        if meta["expires"] is not None and meta["expires"] < time.time():
+            self.delete_path(path)
+            return None
+        return meta
+
+    def get(self, key, default=None, version=None):
+        path = self.key_to_path(key, version)
+        meta = self.read_meta(path)
+        if meta is None:
+            return default
+        try:
+            with open(path, "rb") as value_file:
+                if meta["pickled"]:
+                    return pickle.load(value_file)
+                if not os.fstat(value_file.fileno()).st_size:
+                    return b""
+                # the mapping stays valid after the file is closed or replaced
+                return memoryview(
+                    mmap.mmap(value_file.fileno(), 0, access=mmap.ACCESS_READ)
+                )
+        except FileNotFoundError:
+            return default
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        path = self.key_to_path(key, version)
+        os.makedirs(os.path.dirname(path), 0o700, exist_ok=True)
+        pickled = not isinstance(value, (bytes, bytearray, memoryview))
+        if pickled:
+            value = pickle.dumps(value, self.pickle_protocol)
+        # the value is in place before the sidecar which makes it visible
+        self.write_file(path, value)
+        self.write_meta(path, self.get_backend_timeout(timeout), pickled)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        if self.has_key(key, version):
+            return False
+        self.set(key, value, timeout, version)
+        return True
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        path = self.key_to_path(key, version)
+        meta = self.read_meta(path)
+        if meta is None:
+            return False
+        self.write_meta(path, self.get_backend_timeout(timeout), meta["pickled"])
+        return True
+
+    def delete(self, key, version=None):
+        return self.delete_path(self.key_to_path(key, version))
+
+    def link(self, key, version=None):
+        """hard link the file of a bytes value to a new path, owned by the caller
+
+        Returns None if the value isn't cached or the file system has no
+        hard links. Values are always replaced rather than changed, so the
+        link keeps its content. It is in the store's directory, on the same
+        file system as the value."""
+        path = self.key_to_path(key, version)
+        meta = self.read_meta(path)
+        if meta is None or meta["pickled"]:
+            return None
+        directory = os.path.join(self.location, self.links_directory)
+        os.makedirs(directory, 0o700, exist_ok=True)
+        link_path = os.path.join(directory, uuid.uuid4().hex)
+        try:
+            os.link(path, link_path)
+        except OSError:
+            return None
+        return link_path
+
+    def has_key(self, key, version=None):
+        return self.read_meta(self.key_to_path(key, version)) is not None
+
+    def clear(self):
+        for name in os.listdir(self.location):
+            path = os.path.join(self.location, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def purge_expired(self, stale_after=None):
+        """remove all expired values, returning how many and their total size
+
+        Links and temporary files older than stale_after seconds, left by
+        processes which died before removing them, are also removed, and
+        their size is added to the total"""
+        count = 0
+        reclaimed = 0
+        now = time.time()
+        stale_before = now - (self.stale_after if stale_after is None else stale_after)
+        links = os.path.join(self.location, self.links_directory)
+        for directory, _, names in os.walk(self.location):
+            for name in names:
+                if directory == links or name.startswith(self.temp_prefix):
+                    reclaimed += self.purge_stale(
+                        os.path.join(directory, name), stale_before
+                    )
+                    continue
+                if not name.endswith(self.meta_suffix):
+                    continue
+                path = os.path.join(directory, name[: -len(self.meta_suffix)])
+                try:
+                    with open(path + self.meta_suffix, "rb") as meta_file:
+                        expires = json.load(meta_file)["expires"]
+                    if expires is None or expires >= now:
+                        continue
+                    size = os.path.getsize(path + self.meta_suffix)
+                    size += os.path.getsize(path)
+                except (FileNotFoundError, ValueError):
+                    # removed or being written by another process
+                    continue
+                if self.delete_path(path):
+                    count += 1
+                    reclaimed += size
+        return count, reclaimed
+
+    # pylint: disable=no-self-use
+    def purge_stale(self, path, stale_before):
+        """remove a link or temporary file if it is stale, returning the bytes freed
+
+        A link only frees its bytes if the value it was linked to is gone"""
+        try:
+            stat = os.stat(path)
+            # linking a value changes its ctime, but not its mtime
+            if stat.st_ctime >= stale_before:
+                return 0
+            os.remove(path)
+        except FileNotFoundError:
+            return 0
+        return stat.st_size if stat.st_nlink == 1 else 0
+
+    def write_meta(self, path, expires, pickled):
+        """write the sidecar of a value"""
+        meta = {"expires": expires, "pickled": pickled}
+        self.write_file(path + self.meta_suffix, json.dumps(meta).encode())
+
+    def write_file(self, path, data):
+        """replace a file in one step, so readers never see it half written"""
+        descriptor, temp_path = tempfile.mkstemp(
+            prefix=self.temp_prefix, dir=os.path.dirname(path)
+        )
+        try:
+            with open(descriptor, "wb") as temp_file:
+                temp_file.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def delete_path(self, path):
+        """remove a value and its sidecar"""
+        deleted = False
+        for file_path in (path + self.meta_suffix, path):
+            try:
+                os.remove(file_path)
+                deleted = True
+            except FileNotFoundError:
+                pass
+        return deleted
@@ -0,0 +1,16 @@
+"""URLs of the optional views
+
+Include them in a project's URLconf with
+path("file-resubmit/", include("file_resubmit.urls"))"""
+# pylint: disable=import-error
+
+from django.urls import path
+
+from . import views
+
+app_name = "file_resubmit"  # pylint: disable=invalid-name
+
+urlpatterns = [
+    path("preview/<str:key>", views.preview, name="preview"),
+    path("upload", views.upload, name="upload"),
+]
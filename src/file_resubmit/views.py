@@ -0,0 +1,143 @@
+"""Optional views, included with file_resubmit.urls"""
+# pylint: disable=import-error
+import re
+from urllib.parse import quote
+
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.http import parse_etags, quote_etag
+from django.views.decorators.http import require_POST, require_safe
+
+from .cache import FileCache
+from .widgets import is_valid_key, new_key, upload_access
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+# the types of images shown in the browser, which can't run scripts as SVG can
+INLINE_CONTENT_TYPES = ("image/gif", "image/jpeg", "image/png", "image/webp")
+
+
+class RangeNotSatisfiable(ValueError):
+    """a range request for bytes outside of a file"""
+
+
+def parse_range(header, size):
+    """the first and last byte a Range header asks for
+
+    Returns None when the whole file should be sent: when there is no
+    header, or it is one this view ignores, such as a request for several
+    ranges. Raises RangeNotSatisfiable when the range is outside the file"""
+    match = RANGE_RE.match(header or "")
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if not first:
+        # the last bytes of the file
+        suffix = int(last)
+        if not suffix or not size:
+            raise RangeNotSatisfiable(header)
+        return max(size - suffix, 0), size - 1
+    first = int(first)
+    last = int(last) if last else size - 1
+    if first >= size:
+        raise RangeNotSatisfiable(header)
+    if last < first:
+        return None
+    return first, min(last, size - 1)
+
+
+def content_disposition(content_type, name):
+    """show raster images in the browser, and download anything else
+
+    The content type is the one the uploader sent, so it can't be trusted
+    to be safe to show"""
+    media_type = content_type.split(";", 1)[0].strip().lower()
+    disposition = "inline" if media_type in INLINE_CONTENT_TYPES else "attachment"
+    try:
+        name.encode("ascii")
+    except UnicodeEncodeError:
+        return f"{disposition}; filename*=utf-8''{quote(name)}"
+    name = name.replace("\\", "\\\\").replace('"', '\\"')
+    return f'{disposition}; filename="{name}"'
+
+
+@require_safe
+def preview(request, key):
+    """serve a cached file, so a form can show it before it is saved
+
+    Responses have a strong ETag from the file's checksum, and a single
+    byte range can be asked for. The content is streamed from the cache."""
+    if not is_valid_key(key):
+        raise Http404("The file isn't cached")
+    found = FileCache().get_stream(key)
+    if found is None:
+        raise Http404("The file isn't cached")
+    described, stream = found
+    size = described["size"] or 0
+    etag = quote_etag(described["checksum"]) if described["checksum"] else None
+
+    if etag:
+        etags = parse_etags(request.headers.get("If-None-Match", ""))
+        if etag in etags or "*" in etags:
+            response = HttpResponse(status=304)
+            response["ETag"] = etag
+            return response
+
+    byte_range = None
+    if_range = request.headers.get("If-Range")
+    if not if_range or if_range == etag:
+        try:
+            byte_range = parse_range(request.headers.get("Range"), size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+
+    content_type = described["content_type"] or "application/octet-stream"
+    if byte_range:
+        first, last = byte_range
+        response = StreamingHttpResponse(
+            stream(first, last), status=206, content_type=content_type
+        )
+        response["Content-Range"] = f"bytes {first}-{last}/{size}"
+        response["Content-Length"] = last - first + 1
+    else:
+        response = StreamingHttpResponse(stream(), content_type=content_type)
+        response["Content-Length"] = size
+    if etag:
+        response["ETag"] = etag
+    response["Accept-Ranges"] = "bytes"
+    # cached files are private, and revalidating them with the ETag is cheap
+    response["Cache-Control"] = "private, no-cache"
+    response["Content-Disposition"] = content_disposition(
+        content_type, described["name"] or key
+    )
+    response["X-Content-Type-Options"] = "nosniff"
+    # nothing a cached file holds may run as the site
+    response["Content-Security-Policy"] = "sandbox"
+    return response
+
+
+@require_POST
+def upload(request):
+    """cache a file on its own, before the form it belongs to is submitted
+
+    The file is posted as "file", and the response has the cache key to put
+    in the form's hidden "<field name>_cache_key" field instead. Only signed
+    in users may upload files unless FILE_RESUBMIT_UPLOAD is "anyone", and
+    no one may if it is None"""
+    access = upload_access()
+    if not access:
+        raise Http404("Files can't be uploaded on their own")
+    user = getattr(request, "user", None)
+    if access != "anyone" and not (user and user.is_authenticated):
+        return JsonResponse({"error": "Sign in to upload files"}, status=403)
+    upload_file = request.FILES.get("file")
+    if upload_file is None:
+        return JsonResponse({"error": "No file was uploaded"}, status=400)
+    key = new_key()
+    if not FileCache().set(key, upload_file):
+        return JsonResponse({"error": "The file is too large to cache"}, status=413)
+    return JsonResponse(
+        {"cache_key": key, "name": upload_file.name, "size": upload_file.size},
+        status=201,
+    )
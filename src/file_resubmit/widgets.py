@@ -1,49 +1,130 @@
 """Widgets to use in form fields"""
 # pylint: disable=import-error
 import os
+import re
+import time
 import uuid
 
 from django import forms
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
 from django.forms.widgets import FILE_INPUT_CONTRADICTION
 from django.forms import ClearableFileInput
+from django.urls import NoReverseMatch, reverse
+from django.utils.html import format_html
 from django.utils.safestring import mark_safe
 
 from .cache import FileCache
+from .metrics import report
+
+# between the namespace of a formset and the rest of a cache key
+NAMESPACE_SEPARATOR = "-"
+
+# the keys new_key() makes, and earlier versions made without the time they
+# were made, which are the only keys a form may submit
+KEY_RE = re.compile(r"(?:[A-Za-z0-9_]{1,64}-)?(?:[0-9a-f]{8})?[0-9a-f]{10}")
+
+# the namespaces keys can be made in, which can't have a ":" or the separator
+NAMESPACE_RE = re.compile(r"[A-Za-z0-9_]{1,64}")
 
 
 class ResubmitBaseWidget(ClearableFileInput):
     """base widget, based on ClearableFileInput"""
 
+    # show a cached image, rather than only link to it
+    preview_image = False
+
     def __init__(self, attrs=None, field_type=None):
         super().__init__(attrs=attrs)
         self.field_type = field_type
         self.input_name = None
         self.cache_key = None
+        self.resolved = {}
+
+    def __deepcopy__(self, memo):
+        obj = super().__deepcopy__(memo)
+        obj.resolved = {}
+        return obj
 
     def value_from_datadict(self, data, files, name):
         """override value_from_datadict to return the cached value instead"""
-        upload = super().value_from_datadict(data, files, name)
+        upload = self.submitted_value(data, files, name)
         if upload == FILE_INPUT_CONTRADICTION:
             return upload
+        if self.is_resolved(data, files, name):
+            return self.resolved[name][2]
 
-        self.input_name = f"{name}_cache_key"
-        self.cache_key = data.get(self.input_name, "")
-
+        self.set_cache_key(data, files, name)
+        restored = None
         if name in files:
-            self.cache_key = random_key()[:10]
-            upload = files[name]
-            FileCache().set(self.cache_key, upload)
+            if not FileCache().set(self.cache_key, files[name]):
+                # over the limits, so there is nothing to resubmit
+                self.cache_key = ""
         elif self.cache_key:
             restored = FileCache().get(self.cache_key, name)
-            if restored:
-                upload = restored
-                files[name] = upload
+        return self.resolve(data, files, name, upload, restored)
+
+    def submitted_value(self, data, files, name):
+        """the value submitted with the form, before any file is restored"""
+        return super().value_from_datadict(data, files, name)
+
+    def set_cache_key(self, data, files, name, namespace=None):
+        """use the submitted cache key, or a new one for a new upload"""
+        self.input_name = f"{name}_cache_key"
+        self.cache_key = data.get(self.input_name, "")
+        if self.cache_key and not is_valid_key(self.cache_key):
+            report(
+                FileCache,
+                "get",
+                [(self.cache_key, name, 0, "invalid")],
+                time.perf_counter(),
+            )
+            self.cache_key = ""
+        if name in files:
+            self.cache_key = new_key(namespace)
+
+    def is_resolved(self, data, files, name):
+        """has the file for this data already been stored or restored"""
+        resolved = self.resolved.get(name)
+        return (
+            resolved is not None
+            and resolved[0] == data.get(f"{name}_cache_key", "")
+            and resolved[1] is files.get(name)
+        )
+
+    def resolve(
+        self, data, files, name, upload, restored=None
+    ):  # pylint: disable=too-many-arguments
+        """use a restored file, and remember the file for this data
+
+        This way the file isn't stored or restored again when the form is
+        rendered, or when a resolve_files() call has already done it"""
+        if restored:
+            upload = restored
+            files[name] = upload
+        elif isinstance(upload, UploadedFile) and self.cache_key:
+            # so fields can record what they learn about the file with its entry
+            upload.cache_key = self.cache_key
+        self.resolved[name] = (data.get(self.input_name, ""), files.get(name), upload)
         return upload
 
     def output_extra_data(self, value):
         """filename and hidden field element to add to form"""
         output = ""
-        if value and self.cache_key:
+        preview_url = self.preview_url()
+        if value and preview_url:
+            output += format_html(
+                ' <a href="{}" target="_blank">{}</a>',
+                preview_url,
+                filename_from_value(value),
+            )
+            if self.preview_image:
+                output += format_html(
+                    ' <img src="{}" alt="" class="file-resubmit-preview"'
+                    ' style="max-width: 200px; max-height: 200px">',
+                    preview_url,
+                )
+        elif value and self.cache_key:
             output += " " + filename_from_value(value)
         if self.cache_key:
             output += forms.HiddenInput().render(
@@ -53,6 +134,25 @@ class ResubmitBaseWidget(ClearableFileInput):
             )
         return output
 
+    def get_context(self, name, value, attrs):
+        """tell scripts where files can be uploaded before the form is"""
+        context = super().get_context(name, value, attrs)
+        upload_url = None
+        if upload_access():
+            upload_url = reverse_or_none("file_resubmit:upload")
+        if upload_url:
+            context["widget"]["attrs"]["data-resubmit-upload-url"] = upload_url
+            context["widget"]["attrs"][
+                "data-resubmit-cache-key-name"
+            ] = f"{name}_cache_key"
+        return context
+
+    def preview_url(self):
+        """the URL of the cached file, if file_resubmit.urls is included"""
+        if not self.cache_key:
+            return None
+        return reverse_or_none("file_resubmit:preview", args=[self.cache_key])
+
 
 class ResubmitFileWidget(ResubmitBaseWidget):
     """resubmit widget for files in ordinary forms"""
@@ -75,7 +175,182 @@ class ResubmitFileWidget(ResubmitBaseWidget):
 class ResubmitImageWidget(ResubmitFileWidget):
     """resubmit widget for image files in ordinary forms"""
 
-    pass  # pylint: disable=unnecessary-pass
+    preview_image = True
+
+
+def resolve_files(form):
+    """store and restore the files of all a bound form's resubmit widgets
+
+    However many file fields the form has, this needs one cache round-trip to
+    store all the files and two to restore them: one for their records and
+    one for their content"""
+    pending, uploads, field_names = collect_files(form)
+    file_cache = FileCache()
+    stored = file_cache.set_many(uploads) if uploads else []
+    restored = file_cache.get_many(field_names) if field_names else {}
+    finish_files(form, pending, stored, restored)
+
+
+async def aresolve_files(form):
+    """resolve_files() for async views, which doesn't block on the cache
+
+    Call this before validating the form"""
+    pending, uploads, field_names = collect_files(form)
+    file_cache = FileCache()
+    stored = await file_cache.aset_many(uploads) if uploads else []
+    restored = await file_cache.aget_many(field_names) if field_names else {}
+    finish_files(form, pending, stored, restored)
+
+
+def resolve_formset_files(formset, namespace=None):
+    """store and restore the files of all the forms of a bound formset
+
+    This takes as many round-trips as resolve_files() does for one form, and
+    the files stored are recorded under the formset's namespace"""
+    namespace = namespace or formset_namespace(formset)
+    collected = [collect_files(form, namespace) for form in formset.forms]
+    uploads, field_names = merge_collected(collected)
+    file_cache = FileCache()
+    stored = file_cache.set_many(uploads, namespace=namespace) if uploads else []
+    restored = file_cache.get_many(field_names) if field_names else {}
+    for form, (pending, _, _) in zip(formset.forms, collected):
+        finish_files(form, pending, stored, restored)
+
+
+async def aresolve_formset_files(formset, namespace=None):
+    """resolve_formset_files() for async views"""
+    namespace = namespace or formset_namespace(formset)
+    collected = [collect_files(form, namespace) for form in formset.forms]
+    uploads, field_names = merge_collected(collected)
+    file_cache = FileCache()
+    stored = await file_cache.aset_many(uploads, namespace=namespace) if uploads else []
+    restored = await file_cache.aget_many(field_names) if field_names else {}
+    for form, (pending, _, _) in zip(formset.forms, collected):
+        finish_files(form, pending, stored, restored)
+
+
+def delete_cached_files(form):
+    """remove the cached files of a form's resubmit widgets
+
+    Call this once the form is valid and its files have been saved"""
+    keys = cached_keys(form)
+    if keys:
+        FileCache().delete_many(keys)
+
+
+def delete_formset_files(formset, namespace=None):
+    """remove the cached files of all the forms of a formset
+
+    This includes files of forms which have since been removed from the
+    formset, which were recorded under its namespace"""
+    namespace = namespace or formset_namespace(formset)
+    keys = [key for form in formset.forms for key in cached_keys(form)]
+    FileCache().delete_namespace(namespace, keys)
+
+
+def cached_keys(form):
+    """the cache keys of a form's resubmit widgets"""
+    return [
+        field.widget.cache_key
+        for field in form.fields.values()
+        if isinstance(field.widget, ResubmitBaseWidget) and field.widget.cache_key
+    ]
+
+
+def formset_namespace(formset):
+    """the namespace of the cached files of a formset
+
+    It is part of the cache keys of the files its forms store, so it is
+    carried from one submission of the formset to the next by their hidden
+    fields. A formset without any gets a new one."""
+    for form in formset.forms:
+        for name, field in form.fields.items():
+            if not isinstance(field.widget, ResubmitBaseWidget):
+                continue
+            key = form.data.get(f"{form.add_prefix(name)}_cache_key", "")
+            if is_valid_key(key) and NAMESPACE_SEPARATOR in key:
+                return key.split(NAMESPACE_SEPARATOR, 1)[0]
+    return random_key()[:10]
+
+
+def merge_collected(collected):
+    """combine the files collected from several forms"""
+    uploads = {}
+    field_names = {}
+    for _, form_uploads, form_field_names in collected:
+        uploads.update(form_uploads)
+        field_names.update(form_field_names)
+    return uploads, field_names
+
+
+def collect_files(form, namespace=None):
+    """find the files a bound form's resubmit widgets need to store or restore"""
+    pending = []
+    uploads = {}
+    field_names = {}
+    for name, field in form.fields.items():
+        widget = field.widget
+        name = form.add_prefix(name)
+        if not isinstance(widget, ResubmitBaseWidget):
+            continue
+        upload = widget.submitted_value(form.data, form.files, name)
+        if upload == FILE_INPUT_CONTRADICTION:
+            continue
+        if widget.is_resolved(form.data, form.files, name):
+            continue
+
+        widget.set_cache_key(form.data, form.files, name, namespace)
+        if name in form.files:
+            uploads[widget.cache_key] = form.files[name]
+        elif widget.cache_key:
+            field_names[widget.cache_key] = name
+        pending.append((widget, name, upload))
+    return pending, uploads, field_names
+
+
+def finish_files(form, pending, stored, restored):
+    """hand stored and restored files back to the widgets they belong to"""
+    for widget, name, upload in pending:
+        if name in form.files and widget.cache_key not in stored:
+            widget.cache_key = ""
+        widget.resolve(
+            form.data, form.files, name, upload, restored.get(widget.cache_key)
+        )
+
+
+def reverse_or_none(viewname, args=None):
+    """the URL of one of the optional views, if file_resubmit.urls is included"""
+    try:
+        return reverse(viewname, args=args)
+    except NoReverseMatch:
+        return None
+
+
+def upload_access():
+    """who may upload files on their own with the upload view
+
+    "authenticated" users (the default), "anyone", or no one if it is None"""
+    return getattr(settings, "FILE_RESUBMIT_UPLOAD", "authenticated")
+
+
+def new_key(namespace=None):
+    """a cache key for a new upload, in a namespace if it is given
+
+    It starts with the time it was made, so that a file which can't be found
+    for it later can be told to have expired. A namespace has up to 64
+    letters, digits and underscores."""
+    if namespace and not NAMESPACE_RE.fullmatch(namespace):
+        raise ValueError(f"Invalid cache key namespace: {namespace!r}")
+    key = f"{int(time.time()):08x}{random_key()[:10]}"
+    return f"{namespace}{NAMESPACE_SEPARATOR}{key}" if namespace else key
+
+
+def is_valid_key(key):
+    """is a submitted cache key one new_key() could have made
+
+    Anything else could address the content or other internal entries of the
+    cache, which must never be read as a file's record"""
+    return isinstance(key, str) and KEY_RE.fullmatch(key) is not None
 
 
 def random_key():
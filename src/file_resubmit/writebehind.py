@@ -0,0 +1,180 @@
+"""Storing files in the background, after the request has moved on"""
+# pylint: disable=import-error
+
+import atexit
+import concurrent.futures
+import contextvars
+import io
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from functools import lru_cache, partial
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+
+logger = logging.getLogger(__name__)
+
+
+def copy_upload_file(path):
+    """link, or else copy, the temporary file of an upload
+
+    Django removes it when the request is finished, which may be before the
+    upload is stored"""
+    directory = settings.FILE_UPLOAD_TEMP_DIR or tempfile.gettempdir()
+    copy_path = os.path.join(directory, f"file_resubmit_{uuid.uuid4().hex}.upload")
+    try:
+        os.link(path, copy_path)
+    except OSError:
+        shutil.copyfile(path, copy_path)
+    return copy_path
+
+
+class PendingUpload:
+    """a copy of an upload which is waiting to be stored"""
+
+    def __init__(self, upload):
+        self.name = upload.name
+        self.size = upload.size
+        self.content_type = upload.content_type
+        self.charset = upload.charset
+        self.field_name = getattr(upload, "field_name", None)
+        self.path = None
+        self.content = None
+        if hasattr(upload, "temporary_file_path"):
+            self.path = copy_upload_file(upload.temporary_file_path())
+        else:
+            upload.file.seek(0)
+            self.content = upload.file.read()
+            upload.file.seek(0)
+
+    def open(self, field_name=None):
+        """a new upload with the content of the copy"""
+        if self.path:
+            file = open(self.path, "rb")  # pylint: disable=consider-using-with
+        else:
+            file = io.BytesIO(self.content)
+        upload = UploadedFile(
+            file=file,
+            name=self.name,
+            content_type=self.content_type,
+            size=self.size,
+            charset=self.charset,
+        )
+        upload.field_name = field_name or self.field_name
+        return upload
+
+    def discard(self):
+        """remove the copy, once it has been stored"""
+        if self.path:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class WriteBehind:
+    """Stores files with a pool of worker threads, off the request's critical path
+
+    Files waiting to be stored are kept in memory, or as temporary files if
+    they are large, and can be restored before they have been stored. At
+    most queue_size batches of files wait at once: when the queue is full,
+    submit() refuses more so they are stored straight away instead."""
+
+    def __init__(self, workers, queue_size):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="file_resubmit"
+        )
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.lock = threading.Lock()
+        self.pending = {}
+        # the batch each key waiting to be stored is in
+        self.batches = {}
+
+    def submit(self, store, uploads, *args):
+        """queue uploads to be stored with store(uploads, *args)
+
+        Returns False, without queuing them, if the queue is full"""
+        # pylint: disable-next=consider-using-with
+        if not self.slots.acquire(blocking=False):
+            return False
+        try:
+            copies = {key: PendingUpload(upload) for key, upload in uploads.items()}
+        except BaseException:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.pending.update(copies)
+            # the worker sees the request's context, such as who the owner is
+            future = self.executor.submit(
+                contextvars.copy_context().run, self.store, store, copies, args
+            )
+            self.batches.update(dict.fromkeys(copies, future))
+        future.add_done_callback(partial(self.forget, list(copies)))
+        return True
+
+    def store(self, store, copies, args):
+        """store a batch of files, in a worker thread"""
+        uploads = {key: copy.open() for key, copy in copies.items()}
+        try:
+            store(uploads, *args)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Files could not be stored in the background")
+        finally:
+            for upload in uploads.values():
+                upload.close()
+            with self.lock:
+                for key, copy in copies.items():
+                    if self.pending.get(key) is copy:
+                        del self.pending[key]
+                    copy.discard()
+            self.slots.release()
+
+    def forget(self, keys, future):
+        """stop tracking a batch which has been stored"""
+        with self.lock:
+            for key in keys:
+                if self.batches.get(key) is future:
+                    del self.batches[key]
+
+    def is_pending(self, key):
+        """is the file of a key waiting to be stored"""
+        with self.lock:
+            return key in self.pending
+
+    def restore(self, field_names):
+        """restore the files of some keys which haven't been stored yet"""
+        with self.lock:
+            return {
+                key: self.pending[key].open(field_name)
+                for key, field_name in field_names.items()
+                if key in self.pending
+            }
+
+    def wait(self, keys=None):
+        """wait until the files of some keys, or all files, have been stored
+
+        Only the batches the keys are in are waited for"""
+        with self.lock:
+            if keys is None:
+                futures = set(self.batches.values())
+            else:
+                futures = {self.batches[key] for key in keys if key in self.batches}
+        if futures:
+            concurrent.futures.wait(futures)
+
+    def shutdown(self):
+        """store all the files which are waiting, and stop the workers"""
+        self.wait()
+        self.executor.shutdown(wait=True)
+
+
+@lru_cache(maxsize=None)
+def get_write_behind(workers, queue_size):
+    """the worker pool for these settings, which is flushed when Python exits"""
+    write_behind = WriteBehind(workers, queue_size)
+    atexit.register(write_behind.shutdown)
+    return write_behind
@@ -22,6 +22,8 @@ MIDDLEWARE_CLASSES = []
 
 SECRET_KEY = "123"
 
+ROOT_URLCONF = "tests.urls"
+
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 
 
@@ -1,5 +1,5 @@
 """bw-file-submit tests"""
-# pylint: disable=import-error, too-few-public-methods, protected-access, unnecessary-pass
+# pylint: disable=import-error, too-few-public-methods, protected-access, unnecessary-pass, too-many-lines
 
 try:
     from unittest import mock
@@ -9,22 +9,43 @@ except ImportError:
     except ImportError:
         mock = None
 
+import hashlib
 import os
+import shutil
 import tempfile
+import threading
+import time
+from io import StringIO
 from unittest.mock import patch  # pylint: disable=ungrouped-imports
 
 from django import forms
 from django.contrib.admin.sites import AdminSite
-from django.contrib.admin import ModelAdmin
+from django.contrib.admin import ModelAdmin, TabularInline
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
 from django.contrib.messages.storage.fallback import FallbackStorage
 from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
 from django.db import models
-from django.test import TestCase, RequestFactory
+from django.forms import BaseFormSet, formset_factory
+from django.test import TestCase, RequestFactory, override_settings
+from django.urls import reverse
 from django.views.generic import FormView
 
 from file_resubmit import widgets
 from file_resubmit import admin
+from file_resubmit import cache
+from file_resubmit import fields
+from file_resubmit import forms as resubmit_forms
+from file_resubmit import metrics
+from file_resubmit import middleware
+from file_resubmit import quotas
+from file_resubmit import sharding
+from file_resubmit import storage
+from file_resubmit import views
+from file_resubmit import writebehind
 
 if not mock:
     raise ImproperlyConfigured("For testing mock is required.")
@@ -60,6 +81,54 @@ class OneImageForm(forms.Form):
     upload_image = forms.ImageField(widget=widgets.ResubmitImageWidget())
 
 
+class ResubmitImageForm(forms.Form):
+    """form with a resubmit image field for tests"""
+
+    name = forms.CharField(required=True)
+    upload_image = fields.ResubmitImageField()
+
+
+class TwoImageForm(resubmit_forms.ResubmitFormMixin, forms.Form):
+    """form with two resubmit image fields, whose files are handled in a batch"""
+
+    name = forms.CharField(required=True)
+    cover = fields.ResubmitImageField()
+    back_cover = fields.ResubmitImageField()
+
+
+class ResubmitFormSet(resubmit_forms.ResubmitFormSetMixin, BaseFormSet):
+    """formset for tests"""
+
+    pass
+
+
+OneFileFormSet = formset_factory(OneFileForm, formset=ResubmitFormSet, extra=0)
+
+
+class ManyFileForm(resubmit_forms.ResubmitFormMixin, forms.Form):
+    """form with several files for tests"""
+
+    name = forms.CharField(required=True)
+    upload_file = forms.FileField(widget=widgets.ResubmitFileWidget())
+    other_file = forms.FileField(widget=widgets.ResubmitFileWidget())
+    upload_image = forms.ImageField(widget=widgets.ResubmitImageWidget())
+
+
+class SaveForm(forms.Form):
+    """stand-in for a model form"""
+
+    # pylint: disable=no-self-use,unused-argument
+    def save(self, commit=True):
+        """pretend to save"""
+        return "saved"
+
+
+class SavedFileForm(resubmit_forms.ResubmitFormMixin, SaveForm):
+    """saved file form for tests"""
+
+    upload_file = forms.FileField(widget=widgets.ResubmitFileWidget())
+
+
 class BaseResubmitFileMixin:
     """mixin for testing"""
 
@@ -185,6 +254,36 @@ class TestModelAdmin(ModelAdmin):
         return obj
 
 
+class TestShelfModel(TestModel):
+    """a model whose files are edited inline"""
+
+    admin_name = models.CharField(max_length=100, blank=False)
+
+    def save_base(self, *args, **kwargs):
+        """pretend to save, so the inline files can refer to it"""
+        self.pk = self.pk or 1
+
+
+class TestShelfFileModel(TestModel):
+    """a model to test inline files against"""
+
+    shelf = models.ForeignKey(TestShelfModel, on_delete=models.CASCADE)
+    admin_upload_file = models.FileField(upload_to="fake/")
+
+
+class TestShelfFileInline(admin.AdminResubmitInlineMixin, TabularInline):
+    """an inline to test admin inline files against"""
+
+    model = TestShelfFileModel
+    extra = 0
+
+
+class TestShelfAdmin(admin.AdminResubmitMixin, TestModelAdmin):
+    """an admin with inline files"""
+
+    inlines = [TestShelfFileInline]
+
+
 class TestResubmitAdminWidget(BaseResubmitFileMixin, TestCase):
     """test cases for Admin idgets"""
 
@@ -241,6 +340,25 @@ class TestResubmitAdminWidget(BaseResubmitFileMixin, TestCase):
             "admin_upload_image"
         )
         self.assertIsInstance(image_field.widget, admin.AdminResubmitImageWidget)
+        self.assertIsInstance(image_field, fields.ResubmitImageField)
+
+    def test_admin_form_batched(self):
+        """does the admin's form store and restore its files in a batch"""
+        testadmin = self.TestFileAdmin(model=self.TestFileModel, admin_site=AdminSite())
+        request = self.factory.get("/admin/example/")
+        request.user = self.user
+        form_class = testadmin.get_form(request)
+        self.assertTrue(issubclass(form_class, resubmit_forms.ResubmitFormMixin))
+
+        form = form_class(
+            data={},
+            files={"admin_upload_file": SimpleUploadedFile("a.bin", b"content")},
+        )
+        with patch.object(
+            resubmit_forms, "resolve_files", wraps=resubmit_forms.resolve_files
+        ) as mock_resolve:
+            self.assertFalse(form.is_valid())
+        mock_resolve.assert_called_once_with(form)
 
     def test_image_resubmit_admin(self):
         """test submitting image in admin views"""
@@ -338,3 +456,1407 @@ class TestResubmitAdminWidget(BaseResubmitFileMixin, TestCase):
             saved_obj = testadmin.add_view(resubmit_req)  # <=== BUG here
         self.assertEqual(saved_obj.admin_upload_file.read(), self.temporary_content)
         self.assertEqual(1, 1)
+
+    @override_settings(FILE_RESUBMIT_DELETE_ON_SAVE=True)
+    def test_file_delete_on_save_admin(self):
+        """test the cached file is removed once it is saved in admin views"""
+        testadmin = self.TestFileAdmin(model=self.TestFileModel, admin_site=AdminSite())
+        with open(self.temporary_file.name, "rb") as fo:
+            request = self.factory.post("/admin/example/", {"admin_upload_file": fo})
+        request.user = self.user
+        request._dont_enforce_csrf_checks = True
+        response = testadmin.add_view(request)
+        form = response.context_data["adminform"].form
+        resubmit_field, resubmit_value = self.get_resubmit_field(
+            form, "admin_upload_file"
+        )
+        data = {"admin_name": "Sample", resubmit_field: resubmit_value}
+        resubmit_req = self.factory.post("/admin/example/", data)
+        setattr(resubmit_req, "session", "session")
+        messages = FallbackStorage(resubmit_req)
+        setattr(resubmit_req, "_messages", messages)
+        resubmit_req.user = self.user
+        resubmit_req._dont_enforce_csrf_checks = True
+        with patch("django.contrib.admin.models.LogEntryManager.log_action"):
+            saved_obj = testadmin.add_view(resubmit_req)
+        self.assertEqual(saved_obj.admin_upload_file.read(), self.temporary_content)
+        self.assertIsNone(cache.FileCache().get_metadata(resubmit_value))
+
+    @override_settings(FILE_RESUBMIT_DELETE_ON_SAVE=True)
+    def test_inline_resubmit_save_admin(self):  # pylint: disable=too-many-locals
+        """are inline files resubmitted, and removed once the formset is saved"""
+        testadmin = TestShelfAdmin(model=TestShelfModel, admin_site=AdminSite())
+        prefix = "testshelffilemodel_set"
+        management = {f"{prefix}-TOTAL_FORMS": 2, f"{prefix}-INITIAL_FORMS": 0}
+        files = {
+            f"{prefix}-{index}-admin_upload_file": SimpleUploadedFile(
+                "a.bin", b"%d" % index
+            )
+            for index in range(2)
+        }
+        request = self.factory.post("/admin/example/", {**management, **files})
+        request.user = self.user
+        request._dont_enforce_csrf_checks = True
+        response = testadmin.add_view(request)
+        formset = response.context_data["inline_admin_formsets"][0].formset
+        self.assertIsInstance(formset, resubmit_forms.ResubmitFormSetMixin)
+        namespace = formset.resubmit_namespace
+        keys = [form.fields["admin_upload_file"].widget.cache_key for form in formset]
+        backend = cache.get_cache("file_resubmit")
+        self.assertEqual(backend.get(cache.namespace_key(namespace)), sorted(keys))
+
+        data = {"admin_name": "Sample", **management}
+        for form, cache_key in zip(formset, keys):
+            resubmit_field = f"{form.add_prefix('admin_upload_file')}_cache_key"
+            self.assertIn(f'name="{resubmit_field}" value="{cache_key}"', str(form))
+            data[resubmit_field] = cache_key
+        resubmit_req = self.factory.post("/admin/example/", data)
+        setattr(resubmit_req, "session", "session")
+        messages = FallbackStorage(resubmit_req)
+        setattr(resubmit_req, "_messages", messages)
+        resubmit_req.user = self.user
+        resubmit_req._dont_enforce_csrf_checks = True
+        with patch.object(
+            testadmin, "save_formset", wraps=testadmin.save_formset
+        ) as mock_save, patch("django.contrib.admin.models.LogEntryManager.log_action"):
+            testadmin.add_view(resubmit_req)
+        formset = mock_save.call_args[0][2]
+        self.assertEqual(formset.resubmit_namespace, namespace)
+        self.assertEqual(
+            [form.instance.admin_upload_file.read() for form in formset], [b"0", b"1"]
+        )
+        self.assertIsNone(backend.get(cache.namespace_key(namespace)))
+        file_cache = cache.FileCache()
+        self.assertTrue(all(file_cache.get_metadata(key) is None for key in keys))
+
+
+class TestFileCache(TestCase):  # pylint: disable=too-many-public-methods
+    """test cases for FileCache"""
+
+    def setUp(self):  # pylint: disable=invalid-name
+        """start each test with an empty cache"""
+        super().setUp()
+        cache.get_cache("file_resubmit").clear()
+        self.content = os.urandom(1024)
+
+    def get_upload(self):
+        """an upload to store"""
+        return SimpleUploadedFile("sample.bin", self.content, "application/foo")
+
+    def test_set_get(self):
+        """is a file restored as it was stored"""
+        file_cache = cache.FileCache()
+        file_cache.set("abc", self.get_upload())
+        restored = file_cache.get("abc", "upload_file")
+        self.assertEqual(restored.name, "sample.bin")
+        self.assertEqual(restored.size, 1024)
+        self.assertEqual(restored.content_type, "application/foo")
+        self.assertEqual(restored.read(), self.content)
+
+    def test_get_metadata(self):
+        """is a file described without fetching its content"""
+        file_cache = cache.FileCache()
+        file_cache.set("abc", self.get_upload())
+        backend = cache.get_cache("file_resubmit")
+        with patch.object(backend, "get", wraps=backend.get) as mock_get:
+            metadata = file_cache.get_metadata("abc")
+        self.assertEqual([call[0][0] for call in mock_get.call_args_list], ["abc"])
+        self.assertEqual(metadata["name"], "sample.bin")
+        self.assertEqual(metadata["size"], 1024)
+        self.assertEqual(metadata["content_type"], "application/foo")
+        self.assertEqual(metadata["checksum"], hashlib.sha256(self.content).hexdigest())
+        self.assertIsNotNone(metadata["created"])
+        self.assertIsNone(file_cache.get_metadata("missing"))
+
+    def test_get_legacy(self):
+        """are entries holding their own content still restored"""
+        cache.get_cache("file_resubmit").set(
+            "abc",
+            {
+                "name": "sample.bin",
+                "size": 1024,
+                "content_type": "application/foo",
+                "charset": None,
+                "content": self.content,
+            },
+        )
+        file_cache = cache.FileCache()
+        self.assertEqual(file_cache.get("abc", "upload_file").read(), self.content)
+        self.assertEqual(file_cache.get_metadata("abc")["name"], "sample.bin")
+
+    @override_settings(FILE_RESUBMIT_TIMEOUT=60)
+    def test_timeout(self):
+        """are files cached for the configured time"""
+        backend = cache.get_cache("file_resubmit")
+        with patch.object(backend, "set_many", wraps=backend.set_many) as mock_set:
+            cache.FileCache().set("abc", self.get_upload())
+        self.assertEqual(mock_set.call_args[0][1], 60)
+
+    def test_purge_unsupported(self):
+        """are caches which aren't file based refused by the purge command"""
+        with self.assertRaises(CommandError):
+            call_command("purge_file_resubmit", stdout=StringIO())
+
+    def test_get_missing(self):
+        """is None returned for an unknown key"""
+        self.assertIsNone(cache.FileCache().get("missing", "upload_file"))
+
+    @override_settings(FILE_RESUBMIT_CHUNK_SIZE=256)
+    def test_chunked(self):
+        """is a file stored in chunks and streamed back"""
+        file_cache = cache.FileCache()
+        file_cache.set("abc", self.get_upload())
+        backend = cache.get_cache("file_resubmit")
+        self.assertEqual(cache.unpack_record(backend.get("abc"))["chunks"], 4)
+        self.assertEqual(backend.get(cache.chunk_key("abc", 3)), self.content[768:])
+        restored = file_cache.get("abc", "upload_file")
+        self.assertEqual(restored.name, "sample.bin")
+        self.assertEqual(restored.read(), self.content)
+
+        file_cache.delete("abc")
+        self.assertIsNone(backend.get("abc"))
+        self.assertIsNone(backend.get(cache.chunk_key("abc", 0)))
+
+    @override_settings(FILE_RESUBMIT_CHUNK_SIZE=256)
+    def test_chunked_missing_chunk(self):
+        """is a partly evicted chunked file treated as a miss"""
+        file_cache = cache.FileCache()
+        file_cache.set("abc", self.get_upload())
+        cache.get_cache("file_resubmit").delete(cache.chunk_key("abc", 2))
+        self.assertIsNone(file_cache.get("abc", "upload_file"))
+
+    def test_get_small_in_memory(self):
+        """is a small file restored in memory over the cached bytes"""
+        file_cache = cache.FileCache()
+        file_cache.set("abc", self.get_upload())
+        restored = file_cache.get("abc", "upload_file")
+        self.assertIsInstance(restored.file, cache.MemoryViewFile)
+        self.assertEqual(restored.read(100), self.content[:100])
+        restored.seek(-24, os.SEEK_END)
+        self.assertEqual(restored.read(), self.content[-24:])
+        self.assertEqual(b"".join(restored.chunks()), self.content)
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=512)
+    def test_get_large_on_disk(self):
+        """is a large file restored to a temporary file"""
+        file_cache = cache.FileCache()
+        file_cache.set("abc", self.get_upload())
+        restored = file_cache.get("abc", "upload_file")
+        self.assertTrue(os.path.exists(restored.temporary_file_path()))
+        self.assertEqual(restored.read(), self.content)
+
+    @override_settings(FILE_RESUBMIT_CHUNK_SIZE=256)
+    def test_chunked_small_in_memory(self):
+        """is a small chunked file restored in memory"""
+        file_cache = cache.FileCache()
+        file_cache.set("abc", self.get_upload())
+        restored = file_cache.get("abc", "upload_file")
+        self.assertFalse(hasattr(restored, "temporary_file_path"))
+        self.assertEqual(restored.read(), self.content)
+
+    @override_settings(FILE_RESUBMIT_DEDUPLICATE=True)
+    def test_deduplicate(self):
+        """are identical uploads stored once"""
+        file_cache = cache.FileCache()
+        backend = cache.get_cache("file_resubmit")
+        file_cache.set("abc", self.get_upload())
+        with patch.object(backend, "set_many", wraps=backend.set_many) as mock_set:
+            file_cache.set("def", self.get_upload())
+        # only the small per-key record is written
+        self.assertEqual(list(mock_set.call_args[0][0]), ["def"])
+        self.assertNotIn(
+            "content", cache.unpack_record(mock_set.call_args[0][0]["def"])
+        )
+        self.assertEqual(
+            cache.unpack_record(backend.get("abc"))["blob"],
+            cache.unpack_record(backend.get("def"))["blob"],
+        )
+
+        file_cache.delete("abc")
+        self.assertIsNone(file_cache.get("abc", "upload_file"))
+        self.assertEqual(file_cache.get("def", "upload_file").read(), self.content)
+
+    @override_settings(FILE_RESUBMIT_DEDUPLICATE=True, FILE_RESUBMIT_CHUNK_SIZE=256)
+    def test_deduplicate_chunked(self):
+        """are identical chunked uploads stored once"""
+        file_cache = cache.FileCache()
+        backend = cache.get_cache("file_resubmit")
+        file_cache.set("abc", self.get_upload())
+        with patch.object(backend, "set", wraps=backend.set) as mock_set:
+            file_cache.set("def", self.get_upload())
+        # no chunks are written again
+        self.assertEqual([call[0][0] for call in mock_set.call_args_list], ["def"])
+        self.assertEqual(file_cache.get("def", "upload_file").read(), self.content)
+
+    @override_settings(FILE_RESUBMIT_COMPRESSION="zlib")
+    def test_compression(self):
+        """is compressible content compressed in the cache"""
+        content = b"title,author\n" * 1000
+        file_cache = cache.FileCache()
+        with self.assertLogs("file_resubmit.cache", "DEBUG") as logs:
+            file_cache.set("abc", SimpleUploadedFile("books.csv", content, "text/csv"))
+        self.assertIn("ratio", logs.output[0])
+        backend = cache.get_cache("file_resubmit")
+        self.assertEqual(cache.unpack_record(backend.get("abc"))["codec"], "zlib")
+        self.assertLess(len(backend.get(cache.content_key("abc"))), len(content))
+        self.assertEqual(file_cache.get("abc", "upload_file").read(), content)
+
+    @override_settings(FILE_RESUBMIT_COMPRESSION="zlib")
+    def test_compression_skipped(self):
+        """are small files and compressed content types left alone"""
+        file_cache = cache.FileCache()
+        file_cache.set("abc", SimpleUploadedFile("cover.png", PNG * 100, "image/png"))
+        file_cache.set("def", SimpleUploadedFile("small.txt", b"hi", "text/plain"))
+        backend = cache.get_cache("file_resubmit")
+        self.assertNotIn("codec", cache.unpack_record(backend.get("abc")))
+        self.assertNotIn("codec", cache.unpack_record(backend.get("def")))
+
+    @override_settings(FILE_RESUBMIT_COMPRESSION="lzma", FILE_RESUBMIT_CHUNK_SIZE=256)
+    def test_compression_chunked(self):
+        """are chunks compressed one at a time"""
+        content = b"<p>chapter</p>" * 100
+        file_cache = cache.FileCache()
+        file_cache.set("abc", SimpleUploadedFile("ch.xml", content, "text/xml"))
+        chunk = cache.get_cache("file_resubmit").get(cache.chunk_key("abc", 0))
+        self.assertEqual(cache.decompress(chunk, "lzma"), content[:256])
+        self.assertEqual(file_cache.get("abc", "upload_file").read(), content)
+
+    @override_settings(FILE_RESUBMIT_COMPRESSION="bz2")
+    def test_compression_unknown(self):
+        """is an unknown codec refused"""
+        with self.assertRaises(ImproperlyConfigured):
+            cache.FileCache()
+
+    async def test_async(self):
+        """does the async API store, restore and delete files"""
+        file_cache = cache.FileCache()
+        await file_cache.aset("abc", self.get_upload())
+        restored = await file_cache.aget("abc", "upload_file")
+        self.assertEqual(restored.read(), self.content)
+        await file_cache.adelete("abc")
+        self.assertIsNone(await file_cache.aget("abc", "upload_file"))
+
+    @override_settings(FILE_RESUBMIT_DEDUPLICATE=True, FILE_RESUBMIT_CHUNK_SIZE=256)
+    async def test_async_chunked(self):
+        """does the async API handle chunked and deduplicated files"""
+        file_cache = cache.FileCache()
+        await file_cache.aset("abc", self.get_upload())
+        await file_cache.aset("def", self.get_upload())
+        restored = await file_cache.aget("def", "upload_file")
+        self.assertEqual(restored.read(), self.content)
+
+
+class TestResolveFiles(BaseResubmitFileMixin, TestCase):
+    """test cases for storing and restoring files once per form"""
+
+    @override_settings(FILE_RESUBMIT_DELETE_ON_SAVE=True)
+    def test_delete_on_save(self):
+        """are a form's files removed from the cache once it is saved"""
+        upload = SimpleUploadedFile("sample.bin", b"content")
+        form = SavedFileForm(data={}, files={"upload_file": upload})
+        self.assertTrue(form.is_valid())
+        cache_key = form.fields["upload_file"].widget.cache_key
+
+        form.save(commit=False)
+        self.assertIsNotNone(cache.FileCache().get_metadata(cache_key))
+        form.save()
+        self.assertIsNone(cache.FileCache().get_metadata(cache_key))
+
+    def test_render_does_not_store_again(self):
+        """is an uploaded file cached once for validating and rendering"""
+        upload = SimpleUploadedFile("sample.bin", b"content")
+        form = OneFileForm(data={}, files={"upload_file": upload})
+        with patch.object(cache.FileCache, "set") as mock_set:
+            self.assertFalse(form.is_valid())
+            str(form["upload_file"])
+        self.assertEqual(mock_set.call_count, 1)
+
+    async def test_aresolve_files(self):
+        """are files stored and restored by the async widget hooks"""
+        upload = SimpleUploadedFile("sample.bin", b"content")
+        form = OneFileForm(data={}, files={"upload_file": upload})
+        await widgets.aresolve_files(form)
+        with patch.object(cache.FileCache, "set_many") as mock_set:
+            self.assertFalse(form.is_valid())
+            resubmit_field, resubmit_value = self.get_resubmit_field(
+                form, "upload_file"
+            )
+        mock_set.assert_not_called()
+
+        form = OneFileForm(data={"name": "a", resubmit_field: resubmit_value})
+        await widgets.aresolve_files(form)
+        with patch.object(cache.FileCache, "get_many") as mock_get:
+            self.assertTrue(form.is_valid())
+        mock_get.assert_not_called()
+        self.assertEqual(form.cleaned_data["upload_file"].read(), b"content")
+
+    def test_resubmit_form_mixin(self):
+        """are all the files of a form cached in one round-trip"""
+        files = {
+            "upload_file": SimpleUploadedFile("a.bin", b"aaa"),
+            "other_file": SimpleUploadedFile("b.bin", b"bbb"),
+            "upload_image": SimpleUploadedFile("c.png", PNG),
+        }
+        form = ManyFileForm(data={}, files=files)
+        backend = cache.get_cache("file_resubmit")
+        with patch.object(backend, "set_many", wraps=backend.set_many) as mock_set:
+            self.assertFalse(form.is_valid())
+            str(form)
+        self.assertEqual(mock_set.call_count, 1)
+        # a record and the content of each file
+        self.assertEqual(len(mock_set.call_args[0][0]), 6)
+
+        data = {"name": "a"}
+        for field_name in files:
+            resubmit_field, resubmit_value = self.get_resubmit_field(form, field_name)
+            data[resubmit_field] = resubmit_value
+        form = ManyFileForm(data=data)
+        with patch.object(backend, "get_many", wraps=backend.get_many) as mock_get:
+            self.assertTrue(form.is_valid())
+        # one for the records of all the files, one for their content
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(form.cleaned_data["other_file"].read(), b"bbb")
+        self.assertEqual(form.cleaned_data["upload_image"].read(), PNG)
+
+
+@override_settings(FILE_RESUBMIT_LAZY=True)
+class TestLazyRestore(BaseResubmitFileMixin, TestCase):
+    """test cases for restoring files lazily"""
+
+    def test_lazy_get(self):
+        """is the content only fetched when the file is read"""
+        file_cache = cache.FileCache()
+        file_cache.set("abc", SimpleUploadedFile("sample.bin", b"content"))
+        restored = file_cache.get("abc", "upload_file")
+        self.assertIsInstance(restored, cache.LazyUploadedFile)
+        self.assertEqual(restored.name, "sample.bin")
+        self.assertEqual(restored.size, 7)
+        self.assertFalse(restored.is_loaded)
+        self.assertEqual(restored.read(), b"content")
+        self.assertTrue(restored.is_loaded)
+
+    def test_lazy_get_expired(self):
+        """is a file whose content has expired a miss"""
+        file_cache = cache.FileCache()
+        file_cache.set("abc", SimpleUploadedFile("sample.bin", b"content"))
+        cache.get_cache("file_resubmit").delete(cache.content_key("abc"))
+        self.assertIsNone(file_cache.get("abc", "upload_file"))
+
+        form = OneFileForm(
+            data={}, files={"upload_file": SimpleUploadedFile("a.bin", b"a")}
+        )
+        self.assertFalse(form.is_valid())
+        resubmit_field, resubmit_value = self.get_resubmit_field(form, "upload_file")
+        cache.get_cache("file_resubmit").delete(cache.content_key(resubmit_value))
+        form = OneFileForm(data={"name": "a", resubmit_field: resubmit_value})
+        self.assertFalse(form.is_valid())
+        self.assertIn("upload_file", form.errors)
+
+    @override_settings(FILE_RESUBMIT_CHUNK_SIZE=2)
+    def test_lazy_get_chunk_expired(self):
+        """is a file a miss when one of its chunks has expired"""
+        file_cache = cache.FileCache()
+        file_cache.set("abc", SimpleUploadedFile("sample.bin", b"content"))
+        self.assertIsNotNone(file_cache.get("abc", "upload_file"))
+        cache.get_cache("file_resubmit").delete(cache.chunk_key("abc", 3))
+        self.assertIsNone(file_cache.get("abc", "upload_file"))
+
+    async def test_lazy_aget_expired(self):
+        """is a file whose content has expired a miss with the async API"""
+        file_cache = cache.FileCache()
+        await file_cache.aset("abc", SimpleUploadedFile("sample.bin", b"content"))
+        restored = await file_cache.aget("abc", "upload_file")
+        self.assertIsInstance(restored, cache.LazyUploadedFile)
+        cache.get_cache("file_resubmit").delete(cache.content_key("abc"))
+        self.assertIsNone(await file_cache.aget("abc", "upload_file"))
+
+    def test_lazy_rerender(self):
+        """is the content left in the cache when a form is only re-rendered"""
+        form = OneFileForm(
+            data={}, files={"upload_file": SimpleUploadedFile("a.bin", b"a")}
+        )
+        self.assertFalse(form.is_valid())
+        resubmit_field, resubmit_value = self.get_resubmit_field(form, "upload_file")
+
+        form = OneFileForm(data={resubmit_field: resubmit_value})
+        self.assertFalse(form.is_valid())
+        self.assertIn("a.bin", str(form["upload_file"]))
+        self.assertFalse(form.cleaned_data["upload_file"].is_loaded)
+
+    def test_lazy_image_resubmit(self):
+        """is a lazily restored image validated"""
+        form = OneImageForm(
+            data={}, files={"upload_image": SimpleUploadedFile("a.png", PNG)}
+        )
+        self.assertFalse(form.is_valid())
+        resubmit_field, resubmit_value = self.get_resubmit_field(form, "upload_image")
+
+        form = OneImageForm(data={"name": "a", resubmit_field: resubmit_value})
+        self.assertTrue(form.is_valid())
+        uploaded_image = form.cleaned_data["upload_image"]
+        uploaded_image.open()
+        self.assertEqual(uploaded_image.read(), PNG)
+
+
+class TestFileSystemStore(TestCase):
+    """test cases for FileSystemStore"""
+
+    def setUp(self):  # pylint: disable=invalid-name
+        """store files in a temporary directory"""
+        super().setUp()
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location, ignore_errors=True)
+        settings_override = override_settings(
+            CACHES={
+                "default": {
+                    "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                },
+                "file_resubmit": {
+                    "BACKEND": "file_resubmit.storage.FileSystemStore",
+                    "LOCATION": self.location,
+                },
+            }
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.backend = cache.get_cache("file_resubmit")
+
+    def test_backend(self):
+        """is the store selected in settings"""
+        self.assertIsInstance(self.backend, storage.FileSystemStore)
+
+    def test_bytes(self):
+        """are bytes written as they are and read back through mmap"""
+        self.backend.set("abc", b"content")
+        path = self.backend.key_to_path("abc")
+        self.assertEqual(
+            os.path.dirname(os.path.dirname(os.path.dirname(path))), self.location
+        )
+        with open(path, "rb") as value_file:
+            self.assertEqual(value_file.read(), b"content")
+        self.assertTrue(os.path.exists(path + ".meta"))
+
+        value = self.backend.get("abc")
+        self.assertIsInstance(value, memoryview)
+        self.assertEqual(value, b"content")
+
+    def test_other_values(self):
+        """are other values pickled"""
+        self.backend.set("abc", {"name": "sample.bin"})
+        self.assertEqual(self.backend.get("abc"), {"name": "sample.bin"})
+        self.assertEqual(
+            self.backend.get_many(["abc", "def"]), {"abc": {"name": "sample.bin"}}
+        )
+
+    def test_expiry(self):
+        """are expired values removed"""
+        self.backend.set("abc", b"content", timeout=-1)
+        self.assertFalse(self.backend.has_key("abc"))
+        self.assertIsNone(self.backend.get("abc"))
+        self.assertFalse(os.path.exists(self.backend.key_to_path("abc")))
+        self.assertTrue(self.backend.add("abc", b"new"))
+        self.assertFalse(self.backend.add("abc", b"newer"))
+        self.assertTrue(self.backend.touch("abc"))
+
+    def test_delete_clear(self):
+        """are values deleted"""
+        self.backend.set("abc", b"content")
+        self.backend.set("def", b"content")
+        self.assertTrue(self.backend.delete("abc"))
+        self.assertFalse(self.backend.delete("abc"))
+        self.backend.clear()
+        self.assertIsNone(self.backend.get("def"))
+
+    def test_purge(self):
+        """are expired values purged by the management command"""
+        self.backend.set("abc", b"content", timeout=-1)
+        self.backend.set("def", b"content")
+        out = StringIO()
+        call_command("purge_file_resubmit", stdout=out)
+        self.assertIn("Removed 1 expired entries", out.getvalue())
+        self.assertFalse(os.path.exists(self.backend.key_to_path("abc")))
+        self.assertEqual(self.backend.get("def"), b"content")
+
+    def test_purge_stale(self):
+        """are leftover links and temporary files purged once they are stale"""
+        self.backend.set("abc", b"content")
+        link_path = self.backend.link("abc")
+        self.backend.set("def", b"content")
+        orphan_path = self.backend.link("def")
+        self.backend.delete("def")
+        temp_path = os.path.join(
+            os.path.dirname(self.backend.key_to_path("abc")), "tmpabc123"
+        )
+        with open(temp_path, "wb") as temp_file:
+            temp_file.write(b"half written")
+
+        self.assertEqual(self.backend.purge_expired(), (0, 0))
+        self.assertTrue(os.path.exists(orphan_path))
+        # only the bytes no longer linked from the store are freed
+        self.assertEqual(self.backend.purge_expired(stale_after=-1), (0, 19))
+        for path in (link_path, orphan_path, temp_path):
+            self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.backend.get("abc"), b"content")
+
+        out = StringIO()
+        call_command("purge_file_resubmit", "--stale-after", "0", stdout=out)
+        self.assertIn("Removed 0 expired entries", out.getvalue())
+
+    def test_purge_file_based_cache(self):
+        """are expired FileBasedCache entries purged by the management command"""
+        with override_settings(
+            CACHES={
+                "default": {
+                    "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                },
+                "file_resubmit": {
+                    "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                    "LOCATION": self.location,
+                },
+            }
+        ):
+            backend = cache.get_cache("file_resubmit")
+            backend.set("abc", b"content", timeout=-1)
+            backend.set("def", b"content")
+            out = StringIO()
+            call_command("purge_file_resubmit", stdout=out)
+            self.assertIn("Removed 1 expired entries", out.getvalue())
+            self.assertEqual(backend.get("def"), b"content")
+
+    @override_settings(FILE_RESUBMIT_CHUNK_SIZE=256)
+    def test_file_cache(self):
+        """are files stored and restored through the store"""
+        content = os.urandom(1024)
+        file_cache = cache.FileCache()
+        file_cache.set("abc", SimpleUploadedFile("sample.bin", content))
+        file_cache.set("def", SimpleUploadedFile("sample.bin", content[:100]))
+        self.assertEqual(file_cache.get("abc", "upload_file").read(), content)
+        with override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=10):
+            restored = file_cache.get("def", "upload_file")
+        self.assertEqual(restored.read(), content[:100])
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=10)
+    def test_hand_off(self):
+        """are large files moved into media storage without copying them"""
+        content = os.urandom(1024)
+        file_cache = cache.FileCache()
+        file_cache.set("abc", SimpleUploadedFile("sample.bin", content))
+        restored = file_cache.get("abc", "upload_file")
+        self.assertIsInstance(restored, cache.LinkedUploadedFile)
+        cached_path = self.backend.key_to_path(cache.content_key("abc"))
+        self.assertTrue(os.path.samefile(restored.temporary_file_path(), cached_path))
+
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        name = FileSystemStorage(location=media_root).save("sample.bin", restored)
+        restored.close()
+        saved_path = os.path.join(media_root, name)
+        self.assertTrue(os.path.samefile(saved_path, cached_path))
+        self.assertFalse(os.path.exists(restored.temporary_file_path()))
+        with open(saved_path, "rb") as saved_file:
+            self.assertEqual(saved_file.read(), content)
+        self.assertEqual(file_cache.get("abc", "upload_file").read(), content)
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=10)
+    def test_hand_off_link_removed(self):
+        """are links which aren't moved removed, and compressed files copied"""
+        file_cache = cache.FileCache()
+        file_cache.set("abc", SimpleUploadedFile("sample.bin", b"content" * 10))
+        restored = file_cache.get("abc", "upload_file")
+        restored.close()
+        self.assertFalse(os.path.exists(restored.temporary_file_path()))
+
+        with override_settings(
+            FILE_RESUBMIT_COMPRESSION="zlib", FILE_RESUBMIT_COMPRESSION_MIN_SIZE=0
+        ):
+            file_cache = cache.FileCache()
+            file_cache.set("def", SimpleUploadedFile("sample.txt", b"content" * 10))
+            restored = file_cache.get("def", "upload_file")
+        self.assertNotIsInstance(restored, cache.LinkedUploadedFile)
+        self.assertEqual(restored.read(), b"content" * 10)
+
+
+CALLBACK_EVENTS = []
+
+
+def metrics_callback(**event):
+    """collect metrics events for tests"""
+    CALLBACK_EVENTS.append(event)
+
+
+class TestMetrics(TestCase):
+    """test cases for cache instrumentation"""
+
+    def setUp(self):  # pylint: disable=invalid-name
+        """start from an empty cache and zero counters"""
+        super().setUp()
+        cache.get_cache("file_resubmit").clear()
+        metrics.counters.reset()
+        CALLBACK_EVENTS.clear()
+        self.events = []
+        metrics.file_cache_operation.connect(self.receive)
+        self.addCleanup(metrics.file_cache_operation.disconnect, self.receive)
+
+    def receive(self, sender, **event):  # pylint: disable=unused-argument
+        """collect signalled events"""
+        self.events.append(event)
+
+    def test_signal(self):
+        """is a signal sent for each file handled"""
+        file_cache = cache.FileCache()
+        file_cache.set("abc", SimpleUploadedFile("a.bin", b"content"))
+        file_cache.get_many({"abc": "upload_file", "def": "other_file"})
+        cache.get_cache("file_resubmit").delete(cache.content_key("abc"))
+        file_cache.get("abc", "upload_file")
+        file_cache.delete("abc")
+
+        outcomes = [
+            (event["operation"], event["field_name"], event["size"], event["outcome"])
+            for event in self.events
+        ]
+        self.assertEqual(
+            outcomes,
+            [
+                ("set", None, 7, "stored"),
+                ("get", "upload_file", 7, "hit"),
+                ("get", "other_file", 0, "miss"),
+                ("get", "upload_file", 7, "expired"),
+                ("delete", None, 7, "deleted"),
+            ],
+        )
+        self.assertTrue(all(event["duration"] >= 0 for event in self.events))
+
+    @override_settings(FILE_RESUBMIT_TIMEOUT=60)
+    def test_miss_outcomes(self):
+        """are expired entries told apart from unknown and invalid keys"""
+        now = time.time()
+        with patch("time.time", return_value=now - 120):
+            old_key = widgets.new_key()
+        self.assertTrue(widgets.is_valid_key(old_key))
+        self.assertEqual(cache.key_created(old_key), int(now - 120))
+        new_key = widgets.new_key("0123456789")
+        self.assertTrue(widgets.is_valid_key(new_key))
+
+        file_cache = cache.FileCache()
+        file_cache.get_many({old_key: "upload_file", new_key: "other_file"})
+        self.assertIsNone(file_cache.get_stream(old_key))
+        OneFileForm(data={"upload_file_cache_key": "abc:content"}).is_valid()
+        self.assertEqual(
+            [(event["key"], event["outcome"]) for event in self.events],
+            [
+                (old_key, "expired"),
+                (new_key, "miss"),
+                (old_key, "expired"),
+                ("abc:content", "invalid"),
+            ],
+        )
+
+    def test_counters(self):
+        """are the totals counted"""
+        file_cache = cache.FileCache()
+        file_cache.set_many(
+            {
+                "abc": SimpleUploadedFile("a.bin", b"content"),
+                "def": SimpleUploadedFile("b.bin", b"more content"),
+            }
+        )
+        file_cache.get("ghi", "upload_file")
+        totals = metrics.counters.snapshot()
+        self.assertEqual(totals["set"]["calls"], 1)
+        self.assertEqual(totals["set"]["files"], 2)
+        self.assertEqual(totals["set"]["bytes"], 19)
+        self.assertEqual(totals["set"]["outcomes"], {"stored": 2})
+        self.assertEqual(totals["get"]["outcomes"], {"miss": 1})
+
+    @override_settings(FILE_RESUBMIT_COMPRESSION="zlib")
+    def test_stored_size(self):
+        """are the bytes stored after compression reported"""
+        content = b"title,author\n" * 1000
+        file_cache = cache.FileCache()
+        file_cache.set("abc", SimpleUploadedFile("books.csv", content, "text/csv"))
+        file_cache.set("def", SimpleUploadedFile("a.bin", b"content"))
+        stored = cache.get_cache("file_resubmit").get(cache.content_key("abc"))
+        self.assertEqual(self.events[0]["stored_size"], len(stored))
+        self.assertGreater(self.events[0]["compression_seconds"], 0)
+        self.assertEqual(self.events[1]["stored_size"], 7)
+        self.assertEqual(self.events[1]["compression_seconds"], 0)
+        totals = metrics.counters.snapshot()["set"]
+        self.assertEqual(totals["bytes"], len(content) + 7)
+        self.assertEqual(totals["stored_bytes"], len(stored) + 7)
+        self.assertGreater(totals["bytes"] / totals["stored_bytes"], 1)
+
+    @override_settings(FILE_RESUBMIT_METRICS_CALLBACK="tests.test_all.metrics_callback")
+    def test_callback(self):
+        """is the metrics callback called"""
+        cache.FileCache().set("abc", SimpleUploadedFile("a.bin", b"content"))
+        self.assertEqual(CALLBACK_EVENTS[0]["operation"], "set")
+        self.assertEqual(CALLBACK_EVENTS[0]["key"], "abc")
+
+
+class TestQuotas(TestCase):
+    """test cases for limiting what is cached"""
+
+    factory = RequestFactory()
+
+    def setUp(self):
+        """start with an empty cache and no owner"""
+        super().setUp()
+        cache.get_cache("file_resubmit").clear()
+        token = quotas.current_owner.set("session:abc")
+        self.addCleanup(quotas.current_owner.reset, token)
+
+    @override_settings(FILE_RESUBMIT_MAX_FILE_SIZE=4)
+    def test_max_file_size(self):
+        """are files over the size limit left out of the cache"""
+        file_cache = cache.FileCache()
+        self.assertFalse(file_cache.set("abc", SimpleUploadedFile("a.bin", b"large")))
+        self.assertTrue(file_cache.set("def", SimpleUploadedFile("b.bin", b"tiny")))
+        self.assertIsNone(file_cache.get_metadata("abc"))
+        self.assertEqual(file_cache.get("def", "upload_file").read(), b"tiny")
+
+        form = OneFileForm(
+            data={}, files={"upload_file": SimpleUploadedFile("a.bin", b"large")}
+        )
+        self.assertFalse(form.is_valid())
+        self.assertNotIn('type="hidden"', str(form["upload_file"]))
+
+    @override_settings(
+        FILE_RESUBMIT_MAX_FILE_SIZE=4, FILE_RESUBMIT_OVER_LIMIT="metadata"
+    )
+    def test_over_limit_metadata(self):
+        """can the metadata of files over the limits still be cached"""
+        file_cache = cache.FileCache()
+        self.assertTrue(file_cache.set("abc", SimpleUploadedFile("a.bin", b"large")))
+        described = file_cache.get_metadata("abc")
+        self.assertEqual(described["name"], "a.bin")
+        self.assertEqual(described["size"], 5)
+        self.assertTrue(described["rejected"])
+        self.assertIsNone(file_cache.get("abc", "upload_file"))
+        self.assertFalse(
+            cache.get_cache("file_resubmit").has_key(cache.content_key("abc"))
+        )
+
+    @override_settings(FILE_RESUBMIT_MAX_OWNER_FILES=2, FILE_RESUBMIT_MAX_OWNER_BYTES=8)
+    def test_owner_quota(self):
+        """are the files each owner may cache limited, until they're deleted"""
+        file_cache = cache.FileCache()
+        stored = file_cache.set_many(
+            {
+                "abc": SimpleUploadedFile("a.bin", b"aaa"),
+                "def": SimpleUploadedFile("b.bin", b"bbbbbb"),
+                "ghi": SimpleUploadedFile("c.bin", b"ccc"),
+            }
+        )
+        self.assertEqual(stored, ["abc", "ghi"])
+        self.assertFalse(file_cache.set("jkl", SimpleUploadedFile("d.bin", b"d")))
+
+        # other owners have their own quota
+        token = quotas.current_owner.set("session:def")
+        self.assertTrue(file_cache.set("jkl", SimpleUploadedFile("d.bin", b"d")))
+        quotas.current_owner.reset(token)
+
+        file_cache.delete("abc")
+        self.assertTrue(file_cache.set("mno", SimpleUploadedFile("e.bin", b"eee")))
+
+    @override_settings(FILE_RESUBMIT_MAX_OWNER_FILES=2, FILE_RESUBMIT_TIMEOUT=60)
+    def test_owner_quota_expiry(self):
+        """do files stop counting towards the quota once they have expired"""
+        file_cache = cache.FileCache()
+        now = time.time()
+        with patch("time.time", return_value=now):
+            self.assertTrue(file_cache.set("abc", SimpleUploadedFile("a.bin", b"a")))
+        with patch("time.time", return_value=now + 50):
+            self.assertTrue(file_cache.set("def", SimpleUploadedFile("b.bin", b"b")))
+            self.assertFalse(file_cache.set("ghi", SimpleUploadedFile("c.bin", b"c")))
+        with patch("time.time", return_value=now + 70):
+            self.assertIsNone(file_cache.get_metadata("abc"))
+            self.assertTrue(file_cache.set("ghi", SimpleUploadedFile("c.bin", b"c")))
+            self.assertFalse(file_cache.set("jkl", SimpleUploadedFile("d.bin", b"d")))
+
+    def test_middleware(self):
+        """does the middleware tell the cache who is uploading"""
+        owners = []
+        request = self.factory.get("/", REMOTE_ADDR="10.0.0.1")
+        request.user = AnonymousUser()
+        middleware.ResubmitOwnerMiddleware(
+            lambda request: owners.append(quotas.current_owner.get())
+        )(request)
+        self.assertEqual(owners, ["address:10.0.0.1"])
+        self.assertEqual(quotas.current_owner.get(), "session:abc")
+
+
+class TestPreview(TestCase):
+    """test cases for serving cached files"""
+
+    content = bytes(range(256)) * 4
+
+    def setUp(self):
+        """cache a file to serve"""
+        super().setUp()
+        cache.get_cache("file_resubmit").clear()
+        cache.FileCache().set(
+            "0123456789", SimpleUploadedFile("sample.png", self.content, "image/png")
+        )
+        self.url = reverse("file_resubmit:preview", args=["0123456789"])
+
+    def test_preview(self):
+        """is a cached file served with an ETag"""
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), self.content)
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertEqual(response["Content-Length"], "1024")
+        self.assertEqual(
+            response["ETag"], f'"{hashlib.sha256(self.content).hexdigest()}"'
+        )
+        self.assertEqual(self.client.get(self.url + "x").status_code, 404)
+
+    def test_not_modified(self):
+        """is a file the browser has cached not sent again"""
+        etag = self.client.get(self.url)["ETag"]
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    @override_settings(FILE_RESUBMIT_CHUNK_SIZE=100, FILE_RESUBMIT_COMPRESSION="zlib")
+    def test_range(self):
+        """can part of a file be asked for"""
+        cache.FileCache().set(
+            "abcdef0123", SimpleUploadedFile("sample.bin", self.content, "text/plain")
+        )
+        for url in (self.url, reverse("file_resubmit:preview", args=["abcdef0123"])):
+            response = self.client.get(url, HTTP_RANGE="bytes=250-309")
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response["Content-Range"], "bytes 250-309/1024")
+            self.assertEqual(
+                b"".join(response.streaming_content), self.content[250:310]
+            )
+
+            response = self.client.get(url, HTTP_RANGE="bytes=-24")
+            self.assertEqual(b"".join(response.streaming_content), self.content[-24:])
+
+            response = self.client.get(url, HTTP_RANGE="bytes=2000-")
+            self.assertEqual(response.status_code, 416)
+            self.assertEqual(response["Content-Range"], "bytes */1024")
+
+        response = self.client.get(
+            self.url, HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE='"outdated"'
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_content_disposition(self):
+        """are only raster images shown in the browser"""
+        svg = b'<svg xmlns="http://www.w3.org/2000/svg"><script>alert(1)</script></svg>'
+        cache.FileCache().set(
+            "abcdef0123", SimpleUploadedFile("a.svg", svg, "image/svg+xml")
+        )
+        response = self.client.get(
+            reverse("file_resubmit:preview", args=["abcdef0123"])
+        )
+        self.assertEqual(
+            response["Content-Disposition"], 'attachment; filename="a.svg"'
+        )
+        self.assertEqual(response["Content-Security-Policy"], "sandbox")
+
+        response = self.client.get(self.url)
+        self.assertEqual(
+            response["Content-Disposition"], 'inline; filename="sample.png"'
+        )
+        self.assertEqual(response["Content-Security-Policy"], "sandbox")
+
+    def test_internal_keys(self):
+        """are only keys the widgets make served"""
+        for key in ("0123456789:content", "namespace:abc", "quota:session:abc"):
+            url = reverse("file_resubmit:preview", args=[key])
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_widget_preview(self):
+        """do the widgets link to and show cached files"""
+        form = ManyFileForm(
+            data={},
+            files={"upload_image": SimpleUploadedFile("c.png", PNG, "image/png")},
+        )
+        self.assertFalse(form.is_valid())
+        key = form.fields["upload_image"].widget.cache_key
+        url = reverse("file_resubmit:preview", args=[key])
+        rendered = str(form["upload_image"])
+        self.assertIn(f'<a href="{url}" target="_blank">c.png</a>', rendered)
+        self.assertIn(f'<img src="{url}"', rendered)
+
+
+@override_settings(FILE_RESUBMIT_UPLOAD="anyone")
+class TestUpload(TestCase):
+    """test cases for caching files before their form is submitted"""
+
+    def setUp(self):
+        """start with an empty cache"""
+        super().setUp()
+        cache.get_cache("file_resubmit").clear()
+        self.url = reverse("file_resubmit:upload")
+
+    def test_upload(self):
+        """can a form be submitted with the key of a file uploaded on its own"""
+        response = self.client.post(
+            self.url, {"file": SimpleUploadedFile("a.bin", b"content")}
+        )
+        self.assertEqual(response.status_code, 201)
+        result = response.json()
+        self.assertEqual(result["name"], "a.bin")
+        self.assertEqual(result["size"], 7)
+
+        form = OneFileForm(
+            data={"name": "a", "upload_file_cache_key": result["cache_key"]}
+        )
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data["upload_file"].read(), b"content")
+
+    @override_settings(FILE_RESUBMIT_MAX_FILE_SIZE=4)
+    def test_upload_rejected(self):
+        """are files which can't be cached refused"""
+        self.assertEqual(self.client.post(self.url).status_code, 400)
+        self.assertEqual(self.client.get(self.url).status_code, 405)
+        response = self.client.post(
+            self.url, {"file": SimpleUploadedFile("a.bin", b"content")}
+        )
+        self.assertEqual(response.status_code, 413)
+
+    def test_widget_upload_url(self):
+        """do the widgets tell scripts where to upload files"""
+        rendered = str(OneFileForm()["upload_file"])
+        self.assertIn(f'data-resubmit-upload-url="{self.url}"', rendered)
+        self.assertIn('data-resubmit-cache-key-name="upload_file_cache_key"', rendered)
+
+    @override_settings(FILE_RESUBMIT_UPLOAD="authenticated")
+    def test_upload_authenticated(self):
+        """may only signed in users upload files by default"""
+        upload = SimpleUploadedFile("a.bin", b"content")
+        self.assertEqual(self.client.post(self.url, {"file": upload}).status_code, 403)
+
+        request = RequestFactory().post(
+            self.url, {"file": SimpleUploadedFile("a.bin", b"content")}
+        )
+        request.user = get_user_model()(username="reader")
+        self.assertEqual(views.upload(request).status_code, 201)
+
+    @override_settings(FILE_RESUBMIT_UPLOAD=None)
+    def test_upload_disabled(self):
+        """can the upload view be turned off, and not be advertised"""
+        upload = SimpleUploadedFile("a.bin", b"content")
+        self.assertEqual(self.client.post(self.url, {"file": upload}).status_code, 404)
+        rendered = str(OneFileForm()["upload_file"])
+        self.assertNotIn("data-resubmit-upload-url", rendered)
+
+
+class TestResubmitImageField(BaseResubmitFileMixin, TestCase):
+    """test cases for caching the validation of images"""
+
+    def setUp(self):
+        """start with an empty cache"""
+        super().setUp()
+        cache.get_cache("file_resubmit").clear()
+
+    def resubmit(self, upload):
+        """submit an image with a form which fails validation, then again"""
+        form = ResubmitImageForm(data={}, files={"upload_image": upload})
+        form.is_valid()
+        resubmit_field, resubmit_value = self.get_resubmit_field(form, "upload_image")
+        return form, ResubmitImageForm(
+            data={"name": "a", resubmit_field: resubmit_value}
+        )
+
+    def test_image_validated_once(self):
+        """is a resubmitted image not decoded again"""
+        form, resubmitted = self.resubmit(SimpleUploadedFile("c.png", PNG))
+        self.assertNotIn("upload_image", form.errors)
+        described = cache.FileCache().get_metadata(
+            form.fields["upload_image"].widget.cache_key
+        )
+        self.assertEqual(described["checksum"], hashlib.sha256(PNG).hexdigest())
+
+        with patch("PIL.Image.open") as mock_open:
+            self.assertTrue(resubmitted.is_valid())
+        mock_open.assert_not_called()
+        image = resubmitted.cleaned_data["upload_image"]
+        self.assertEqual(image.image.format, "PNG")
+        self.assertEqual(image.image.size, (1, 1))
+        self.assertEqual(image.content_type, "image/png")
+        self.assertEqual(image.read(), PNG)
+
+    def test_invalid_image_validated_once(self):
+        """is a resubmitted file which isn't an image rejected without decoding"""
+        form, resubmitted = self.resubmit(SimpleUploadedFile("c.png", b"not a png"))
+        self.assertIn("upload_image", form.errors)
+        with patch("PIL.Image.open") as mock_open:
+            self.assertFalse(resubmitted.is_valid())
+        mock_open.assert_not_called()
+        self.assertIn("upload_image", resubmitted.errors)
+
+    def test_forged_record(self):
+        """can't an upload be submitted as the record of another file"""
+        forged = cache.pack_record(
+            {
+                "name": "c.png",
+                "size": 8,
+                "content_type": "image/png",
+                "checksum": "forged",
+                "image": {"valid": True, "format": "PNG", "checksum": "forged"},
+                "content": b"not a png",
+            }
+        )
+        form, _ = self.resubmit(SimpleUploadedFile("c.txt", forged, "text/plain"))
+        cache_key = form.fields["upload_image"].widget.cache_key
+        self.assertIsNone(cache.FileCache().get(cache.content_key(cache_key), "a"))
+        for key in (cache.content_key(cache_key), "namespace:abc", "quota:abc"):
+            resubmitted = ResubmitImageForm(
+                data={"name": "a", "upload_image_cache_key": key}
+            )
+            self.assertFalse(resubmitted.is_valid())
+            self.assertEqual(resubmitted["upload_image"].field.widget.cache_key, "")
+
+    def test_image_info_batched(self):
+        """does a form record the validation of all its images in one batch"""
+        backend = cache.get_cache("file_resubmit")
+        form = TwoImageForm(
+            data={},
+            files={
+                "cover": SimpleUploadedFile("c.png", PNG),
+                "back_cover": SimpleUploadedFile("b.png", b"not a png"),
+            },
+        )
+        with patch.object(
+            backend, "get_many", wraps=backend.get_many
+        ) as mock_get, patch.object(
+            backend, "set_many", wraps=backend.set_many
+        ) as mock_set:
+            self.assertFalse(form.is_valid())
+        # one call stores the files, and one reads and one writes their records
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(mock_set.call_count, 2)
+
+        data = {"name": "a"}
+        for name in ("cover", "back_cover"):
+            data[f"{name}_cache_key"] = form.fields[name].widget.cache_key
+        with patch("PIL.Image.open") as mock_open:
+            resubmitted = TwoImageForm(data=data)
+            self.assertFalse(resubmitted.is_valid())
+        mock_open.assert_not_called()
+        self.assertIn("back_cover", resubmitted.errors)
+        self.assertEqual(resubmitted.cleaned_data["cover"].image.format, "PNG")
+
+    def test_changed_content(self):
+        """is a validation result not used for other content"""
+        form, resubmitted = self.resubmit(SimpleUploadedFile("c.png", PNG))
+        cache_key = form.fields["upload_image"].widget.cache_key
+        backend = cache.get_cache("file_resubmit")
+        state = cache.unpack_record(backend.get(cache_key))
+        backend.set(cache_key, cache.pack_record(dict(state, checksum="other")))
+        with patch("PIL.Image.open", side_effect=OSError) as mock_open:
+            self.assertFalse(resubmitted.is_valid())
+        mock_open.assert_called_once()
+
+
+class TestFormSet(BaseResubmitFileMixin, TestCase):
+    """test cases for the files of formsets"""
+
+    def setUp(self):
+        """start with an empty cache"""
+        super().setUp()
+        cache.get_cache("file_resubmit").clear()
+
+    def submit(self, count):
+        """submit a formset with a file in each of its forms"""
+        data = {"form-TOTAL_FORMS": count, "form-INITIAL_FORMS": 0}
+        files = {
+            f"form-{index}-upload_file": SimpleUploadedFile("a.bin", b"%d" % index)
+            for index in range(count)
+        }
+        formset = OneFileFormSet(data=data, files=files)
+        self.assertFalse(formset.is_valid())
+        return formset
+
+    def resubmit_data(self, formset, count):
+        """the data to submit a formset again with its cached files"""
+        data = {"form-TOTAL_FORMS": count, "form-INITIAL_FORMS": 0}
+        for form in formset.forms[:count]:
+            rendered = str(form["upload_file"])
+            cache_key = form.fields["upload_file"].widget.cache_key
+            resubmit_field = f"{form.add_prefix('upload_file')}_cache_key"
+            self.assertIn(f'name="{resubmit_field}" value="{cache_key}"', rendered)
+            data[resubmit_field] = cache_key
+            data[form.add_prefix("name")] = "a"
+        return data
+
+    def test_formset(self):
+        """are the files of a formset stored and restored in a batch"""
+        backend = cache.get_cache("file_resubmit")
+        with patch.object(backend, "set_many", wraps=backend.set_many) as mock_set:
+            formset = self.submit(3)
+        self.assertEqual(mock_set.call_count, 1)
+        namespace = formset.resubmit_namespace
+        keys = [form.fields["upload_file"].widget.cache_key for form in formset]
+        self.assertTrue(all(key.startswith(f"{namespace}-") for key in keys))
+        self.assertEqual(backend.get(cache.namespace_key(namespace)), sorted(keys))
+
+        formset = OneFileFormSet(data=self.resubmit_data(formset, 3))
+        with patch.object(backend, "get_many", wraps=backend.get_many) as mock_get:
+            self.assertTrue(formset.is_valid())
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(formset.resubmit_namespace, namespace)
+        self.assertEqual(formset.cleaned_data[2]["upload_file"].read(), b"2")
+
+    def test_delete_formset_files(self):
+        """are the files of forms which were removed deleted with the formset"""
+        formset = self.submit(3)
+        namespace = formset.resubmit_namespace
+        keys = [form.fields["upload_file"].widget.cache_key for form in formset]
+
+        # the last form is removed before the formset is submitted again
+        formset = OneFileFormSet(data=self.resubmit_data(formset, 2))
+        self.assertTrue(formset.is_valid())
+        formset.delete_cached_files()
+        file_cache = cache.FileCache()
+        self.assertTrue(all(file_cache.get_metadata(key) is None for key in keys))
+        self.assertIsNone(
+            cache.get_cache("file_resubmit").get(cache.namespace_key(namespace))
+        )
+
+    def test_custom_namespace(self):
+        """can a formset's files be cached under a namespace of its own"""
+        plain_formset = formset_factory(OneFileForm, extra=0)
+        formset = plain_formset(
+            data={"form-TOTAL_FORMS": 1, "form-INITIAL_FORMS": 0},
+            files={"form-0-upload_file": SimpleUploadedFile("a.bin", b"book")},
+        )
+        widgets.resolve_formset_files(formset, namespace="books")
+        self.assertFalse(formset.is_valid())
+        cache_key = formset.forms[0].fields["upload_file"].widget.cache_key
+        self.assertTrue(cache_key.startswith("books-"))
+
+        formset = plain_formset(data=self.resubmit_data(formset, 1))
+        widgets.resolve_formset_files(formset, namespace="books")
+        self.assertTrue(formset.is_valid())
+        self.assertEqual(formset.cleaned_data[0]["upload_file"].read(), b"book")
+        widgets.delete_formset_files(formset, namespace="books")
+        self.assertIsNone(cache.FileCache().get_metadata(cache_key))
+
+        with self.assertRaises(ValueError):
+            widgets.new_key("books:content")
+
+
+SHARDS = ["shard_a", "shard_b", "shard_c"]
+
+
+@override_settings(
+    CACHES={
+        alias: {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": alias,
+        }
+        for alias in ["default", "file_resubmit", *SHARDS, "shard_d"]
+    },
+    FILE_RESUBMIT_CACHES=SHARDS,
+)
+class TestShardedCache(BaseResubmitFileMixin, TestCase):
+    """test cases for spreading files over several caches"""
+
+    keys = [widgets.random_key()[:10] for _ in range(1000)]
+
+    def test_spread(self):
+        """are keys spread evenly over the caches"""
+        sharded = sharding.ShardedCache(SHARDS)
+        counts = {alias: 0 for alias in SHARDS}
+        for key in self.keys:
+            counts[sharded.alias_for(key)] += 1
+        self.assertTrue(all(count > 200 for count in counts.values()), counts)
+
+    def test_adding_a_cache(self):
+        """does adding a cache only move keys to the new cache"""
+        before = sharding.ShardedCache(SHARDS)
+        after = sharding.ShardedCache([*SHARDS, "shard_d"])
+        moved = [
+            key for key in self.keys if before.alias_for(key) != after.alias_for(key)
+        ]
+        self.assertLess(len(moved), 400)
+        self.assertTrue(all(after.alias_for(key) == "shard_d" for key in moved))
+
+    def test_file_cache(self):
+        """are files stored over the caches and restored from them"""
+        file_cache = cache.FileCache()
+        uploads = {
+            key: SimpleUploadedFile("a.bin", key.encode()) for key in self.keys[:30]
+        }
+        self.assertEqual(sorted(file_cache.set_many(uploads)), sorted(uploads))
+        self.assertFalse(cache.get_cache("file_resubmit").get_many(list(uploads)))
+        for alias in SHARDS:
+            self.assertTrue(cache.get_cache(alias).get_many(list(uploads)))
+
+        restored = file_cache.get_many({key: "upload_file" for key in uploads})
+        self.assertEqual(restored[self.keys[0]].read(), self.keys[0].encode())
+        file_cache.delete_many(list(uploads))
+        self.assertFalse(file_cache.get_many({key: "upload_file" for key in uploads}))
+
+    async def test_async(self):
+        """does the async API work with several caches"""
+        file_cache = cache.FileCache()
+        await file_cache.aset("abc", SimpleUploadedFile("a.bin", b"content"))
+        restored = await file_cache.aget("abc", "upload_file")
+        self.assertEqual(restored.read(), b"content")
+
+
+class TestRecordFormat(BaseResubmitFileMixin, TestCase):
+    """test cases for how records are written"""
+
+    def setUp(self):
+        """start with an empty cache"""
+        super().setUp()
+        cache.get_cache("file_resubmit").clear()
+
+    def test_pack_record(self):
+        """are records written as bytes and read back without pickle"""
+        state = {"name": "a.bin", "size": 3, "image": {"valid": False}}
+        packed = cache.pack_record(dict(state, content=b"abc"))
+        self.assertIsInstance(packed, bytes)
+        self.assertTrue(packed.startswith(cache.RECORD_MAGIC))
+        unpacked = cache.unpack_record(memoryview(packed))
+        self.assertEqual(bytes(unpacked.pop("content")), b"abc")
+        self.assertEqual(unpacked, state)
+
+        self.assertEqual(cache.unpack_record(state), state)
+        self.assertIsNone(cache.unpack_record(b"FRR\x09" + packed[4:]))
+        self.assertIsNone(cache.unpack_record(b"FR"))
+        self.assertIsNone(cache.unpack_record(["abc", "def"]))
+        self.assertIsNone(cache.unpack_record(None))
+        self.assertIsNone(cache.unpack_record(quotas.empty_usage()))
+
+    def test_file_cache(self):
+        """are files stored with binary records"""
+        file_cache = cache.FileCache()
+        file_cache.set("abc", SimpleUploadedFile("a.bin", b"content"))
+        self.assertIsInstance(cache.get_cache("file_resubmit").get("abc"), bytes)
+        self.assertEqual(file_cache.get("abc", "upload_file").read(), b"content")
+
+    def test_earlier_records(self):
+        """are records written as dicts by earlier versions still read"""
+        cache.get_cache("file_resubmit").set(
+            "def",
+            {
+                "name": "a.bin",
+                "size": 7,
+                "content_type": "application/octet-stream",
+                "charset": None,
+                "content": b"content",
+            },
+        )
+        file_cache = cache.FileCache()
+        self.assertEqual(file_cache.get("def", "upload_file").read(), b"content")
+        self.assertEqual(file_cache.get_metadata("def")["name"], "a.bin")
+
+
+@override_settings(
+    FILE_RESUBMIT_WRITE_BEHIND=True,
+    FILE_RESUBMIT_WRITE_BEHIND_WORKERS=2,
+    FILE_RESUBMIT_WRITE_BEHIND_QUEUE_SIZE=1,
+)
+class TestWriteBehind(BaseResubmitFileMixin, TestCase):
+    """test cases for storing files in the background"""
+
+    def setUp(self):
+        """start with an empty cache, and hold up the workers until released"""
+        super().setUp()
+        cache.get_cache("file_resubmit").clear()
+        self.released = threading.Event()
+        store_many = cache.FileCache.store_many
+
+        def held_store_many(file_cache, uploads, namespace=None):
+            if threading.current_thread() is not threading.main_thread():
+                self.released.wait(5)
+            return store_many(file_cache, uploads, namespace)
+
+        patcher = patch.object(cache.FileCache, "store_many", held_store_many)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.flush)
+
+    def flush(self):
+        """let the workers store everything which is waiting"""
+        self.released.set()
+        writebehind.get_write_behind(2, 1).wait()
+
+    def test_get_pending(self):
+        """is a file which hasn't been stored yet restored from its copy"""
+        file_cache = cache.FileCache()
+        self.assertTrue(file_cache.set("abc", SimpleUploadedFile("a.bin", b"content")))
+        self.assertIsNone(cache.get_cache("file_resubmit").get("abc"))
+        restored = file_cache.get("abc", "upload_file")
+        self.assertEqual(restored.read(), b"content")
+        self.assertEqual(restored.cache_key, "abc")
+        self.assertEqual(restored.field_name, "upload_file")
+
+        self.flush()
+        self.assertIsNotNone(cache.get_cache("file_resubmit").get("abc"))
+        self.assertEqual(file_cache.get("abc", "upload_file").read(), b"content")
+
+    def test_queue_full(self):
+        """are files stored straight away when the queue is full"""
+        file_cache = cache.FileCache()
+        file_cache.set("abc", SimpleUploadedFile("a.bin", b"first"))
+        file_cache.set("def", SimpleUploadedFile("b.bin", b"second"))
+        self.assertIsNone(cache.get_cache("file_resubmit").get("abc"))
+        self.assertIsNotNone(cache.get_cache("file_resubmit").get("def"))
+
+    @override_settings(FILE_RESUBMIT_MAX_FILE_SIZE=4)
+    def test_expected_keys(self):
+        """are files over the size limit left out of the keys returned"""
+        file_cache = cache.FileCache()
+        uploads = {
+            "abc": SimpleUploadedFile("a.bin", b"abc"),
+            "def": SimpleUploadedFile("b.bin", b"too large"),
+        }
+        self.assertEqual(file_cache.set_many(uploads), ["abc"])
+
+    def test_delete_pending(self):
+        """does deleting a file wait for it to be stored first"""
+        file_cache = cache.FileCache()
+        file_cache.set("abc", SimpleUploadedFile("a.bin", b"content"))
+        threading.Timer(0.05, self.released.set).start()
+        file_cache.delete("abc")
+        self.assertIsNone(cache.get_cache("file_resubmit").get("abc"))
+        self.assertIsNone(file_cache.get("abc", "upload_file"))
+
+    def test_wait_for_batch(self):
+        """does waiting for a key only wait for the batch it is in"""
+        write_behind = writebehind.WriteBehind(2, 4)
+        self.addCleanup(write_behind.shutdown)
+        stored = []
+
+        def store(uploads, wait=None):
+            if wait:
+                wait.wait(5)
+            stored.extend(uploads)
+
+        write_behind.submit(
+            store, {"abc": SimpleUploadedFile("a.bin", b"a")}, self.released
+        )
+        write_behind.submit(store, {"def": SimpleUploadedFile("b.bin", b"b")})
+        write_behind.wait(["def"])
+        self.assertEqual(stored, ["def"])
+        self.assertTrue(write_behind.is_pending("abc"))
+        self.released.set()
+        write_behind.wait(["abc"])
+        self.assertEqual(stored, ["def", "abc"])
+
+    def test_image_info_pending(self):
+        """is image info skipped, rather than waited for, while a file is pending"""
+        file_cache = cache.FileCache()
+        file_cache.set("abc", SimpleUploadedFile("a.png", PNG, "image/png"))
+        self.assertFalse(file_cache.set_image_info("abc", {"valid": True}))
+        self.flush()
+        self.assertTrue(file_cache.set_image_info("abc", {"valid": True}))
+
+    async def test_async(self):
+        """does the async API store files in the background"""
+        file_cache = cache.FileCache()
+        self.assertTrue(
+            await file_cache.aset("abc", SimpleUploadedFile("a.bin", b"content"))
+        )
+        restored = await file_cache.aget("abc", "upload_file")
+        self.assertEqual(restored.read(), b"content")
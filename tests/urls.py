@@ -0,0 +1,6 @@
+"""urls for tests"""
+from django.urls import include, path
+
+urlpatterns = [
+    path("file-resubmit/", include("file_resubmit.urls")),
+]